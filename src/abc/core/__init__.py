@@ -24,6 +24,12 @@ class MetadataABC(ABC):
     def error(self, name, url):
         raise NotImplemented
 
+    def completed(self):
+        return iter(())
+
+    def close(self):
+        pass
+
 
 class StreamABC(ABC):
     response_wait_key = None
@@ -42,3 +48,6 @@ class StreamABC(ABC):
     def set_next(self, value):
         raise NotImplemented
 
+    def restore(self, url):
+        pass
+
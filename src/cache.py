@@ -0,0 +1,183 @@
+import logging
+import asyncio
+import json
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+
+
+log = logging.getLogger(__file__)
+log_handler = logging.StreamHandler()
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+log_handler.setFormatter(formatter)
+log.addHandler(log_handler)
+log.setLevel(logging.INFO)
+
+
+class CachedContent:
+    def __init__(self, body: bytes):
+        self.body = body
+
+    async def read(self) -> bytes:
+        return self.body
+
+    async def iter_chunked(self, n: int):
+        for i in range(0, len(self.body), n):
+            yield self.body[i:i + n]
+
+
+class CachedResponse:
+    def __init__(self, url: str, body: bytes, headers, from_cache: bool):
+        self.url = url
+        self.status = 200
+        self.headers = headers
+        self.from_cache = from_cache
+        self.content = CachedContent(body)
+        self.body = body
+
+    async def read(self) -> bytes:
+        return self.body
+
+    async def text(self, encoding: str = 'utf-8') -> str:
+        return self.body.decode(encoding)
+
+    async def json(self, loads=json.loads, **kwargs):
+        return loads(self.body.decode('utf-8'))
+
+
+class CachedRequest:
+    def __init__(self, cache, session, url: str, headers: dict = None, **kwargs):
+        self.cache = cache
+        self.session = session
+        self.url = url
+        self.headers = headers
+        self.kwargs = kwargs
+        self.request = None
+
+    async def __aenter__(self):
+        headers = dict(self.headers) if self.headers is not None else {}
+        headers.update(self.cache.validators(self.url))
+        self.request = self.session.get(self.url, headers=headers, **self.kwargs)
+        response = await self.request.__aenter__()
+        if response.status == 304 and self.url in self.cache:
+            body = await asyncio.to_thread(self.cache.read, self.url)
+            self.cache.touch(self.url)
+            self.cache.hits += 1
+            return CachedResponse(self.url, body, response.headers, from_cache=True)
+        elif response.status == 200 and self.cache.is_cacheable(response.headers):
+            body = await response.read()
+            await asyncio.to_thread(self.cache.write, self.url, body)
+            self.cache.put(self.url, len(body), response.headers)
+            self.cache.misses += 1
+            return CachedResponse(self.url, body, response.headers, from_cache=False)
+        else:
+            return response
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        return await self.request.__aexit__(exc_type, exc_val, exc_tb)
+
+
+class CachedSession:
+    def __init__(self, session, cache):
+        self.session = session
+        self.cache = cache
+
+    def get(self, url: str, headers: dict = None, **kwargs) -> CachedRequest:
+        return CachedRequest(self.cache, self.session, url, headers=headers, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+
+class HttpCache:
+    index_filename = 'index.json'
+
+    def __init__(self, basepath: Path, max_bytes: int = 2**30):
+        self.basepath = basepath.resolve()
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        # id -> validators and size, least recently used first
+        self.entries = OrderedDict()
+        self.load()
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.basepath}, entries={len(self.entries)}, nbytes={self.nbytes})'
+
+    def __contains__(self, url: str) -> bool:
+        return self.key(url) in self.entries
+
+    @staticmethod
+    def key(url: str) -> str:
+        return str(uuid.uuid5(uuid.NAMESPACE_DNS, url))
+
+    @staticmethod
+    def is_cacheable(headers) -> bool:
+        return 'ETag' in headers or 'Last-Modified' in headers
+
+    def index_filepath(self) -> Path:
+        return self.basepath.joinpath(self.index_filename)
+
+    def filepath(self, key: str) -> Path:
+        return self.basepath.joinpath(f'{key}.body')
+
+    def load(self):
+        try:
+            with self.index_filepath().open('r', encoding='utf-8') as f:
+                self.entries = OrderedDict(json.load(f))
+        except FileNotFoundError:
+            self.entries = OrderedDict()
+        self.nbytes = sum(entry['nbytes'] for entry in self.entries.values())
+
+    def save(self):
+        self.basepath.mkdir(parents=True, exist_ok=True)
+        with self.index_filepath().open('w', encoding='utf-8') as f:
+            json.dump(list(self.entries.items()), f)
+
+    def validators(self, url: str) -> dict:
+        entry = self.entries.get(self.key(url))
+        headers = {}
+        if entry is not None:
+            if entry['etag'] is not None:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified'] is not None:
+                headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def read(self, url: str) -> bytes:
+        return self.filepath(self.key(url)).read_bytes()
+
+    def write(self, url: str, body: bytes):
+        self.basepath.mkdir(parents=True, exist_ok=True)
+        self.filepath(self.key(url)).write_bytes(body)
+
+    def touch(self, url: str):
+        self.entries.move_to_end(self.key(url))
+
+    def put(self, url: str, nbytes: int, headers):
+        # the index is only updated from the event loop, bodies are read and written in threads
+        key = self.key(url)
+        previous = self.entries.pop(key, None)
+        if previous is not None:
+            self.nbytes -= previous['nbytes']
+        self.entries[key] = {'etag': headers.get('ETag'), 'last_modified': headers.get('Last-Modified'),
+                             'nbytes': nbytes}
+        self.nbytes += nbytes
+        self.evict()
+
+    def evict(self):
+        while self.nbytes > self.max_bytes and len(self.entries) > 1:
+            key, entry = self.entries.popitem(last=False)
+            self.filepath(key).unlink(True)
+            self.nbytes -= entry['nbytes']
+
+    def wrap(self, session) -> CachedSession:
+        return CachedSession(session, self)
+
+    def clean(self):
+        for key in self.entries:
+            self.filepath(key).unlink(True)
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.index_filepath().unlink(True)
@@ -1,9 +1,27 @@
 import logging
 import aiohttp
 import asyncio
+import yarl
 import urllib
 from abc import abstractmethod
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import functools
 import csv
+import array
+import os
+import time
+import uuid
+import sqlite3
+import threading
+import hashlib
+import random
+import collections
+import mmap
+import itertools
+import shutil
+import inspect
+from pathlib import Path
 from .abc.core import MetadataABC, StreamABC
 
 
@@ -15,6 +33,68 @@ log.addHandler(log_handler)
 log.setLevel(logging.INFO)
 
 
+def remove_files(basepath: Path, filenames, workers: int = 8, batch_size: int = 1024) -> int:
+    # unlinks are syscall bound, so batches of them run in threads
+    def unlink(batch: list) -> int:
+        removed = 0
+        for filename in batch:
+            try:
+                os.unlink(basepath.joinpath(filename))
+                removed += 1
+            except FileNotFoundError:
+                pass
+        return removed
+
+    filenames = iter(filenames)
+    batches = iter(lambda: list(itertools.islice(filenames, batch_size)), [])
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return sum(executor.map(unlink, batches))
+
+
+class Layout:
+    def __init__(self, depth: int = 2, width: int = 2):
+        # depth 2 and width 2 fans out into 65536 directories, enough for hundreds of millions of files
+        self.depth = depth
+        self.width = width
+        self.directories = set()
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(depth={self.depth}, width={self.width})'
+
+    def __getstate__(self):
+        return {'depth': self.depth, 'width': self.width}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def shard(self, id: str) -> str:
+        return '/'.join(id[i * self.width:(i + 1) * self.width] for i in range(self.depth))
+
+    def directory(self, basepath: Path, id: str) -> Path:
+        directory = basepath.joinpath(self.shard(id)) if self.depth > 0 else basepath
+        if directory not in self.directories:
+            directory.mkdir(parents=True, exist_ok=True)
+            with self.lock:
+                self.directories.add(directory)
+        return directory
+
+    def shards(self, basepath: Path) -> list:
+        if self.depth == 0 or not basepath.exists():
+            return []
+        return [path for path in basepath.iterdir() if path.is_dir() and len(path.name) == self.width]
+
+    def remove(self, basepath: Path, shards: list = None, workers: int = 8):
+        # drops whole top level shards at once instead of unlinking file by file
+        basepath = basepath.resolve()
+        paths = self.shards(basepath) if shards is None else [basepath.joinpath(shard) for shard in shards]
+        with self.lock:
+            self.directories = {directory for directory in self.directories
+                                if not any(directory.is_relative_to(path) for path in paths)}
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(functools.partial(shutil.rmtree, ignore_errors=True), paths))
+
+
 class DummyMetadata(MetadataABC):
     def write(self, output):
         pass
@@ -30,11 +110,17 @@ class CSVMetadata(MetadataABC):
     file_extension = 'csv'
     filename = 'metadata'
 
+    @staticmethod
+    def row(output) -> list:
+        nbytes = '' if output.nbytes is None else str(output.nbytes)
+        offset = '' if output.offset is None else str(output.offset)
+        return [str(output.length()), output.filename(), output.url, nbytes, offset]
+
     def write(self, output):
-        if len(output.content) > 0:
+        if not output.is_empty():
             with self.filepath().open('a', encoding='utf-8', newline='') as f:
                 csv_writer = csv.writer(f)
-                csv_writer.writerow([str(len(output.content)), output.filepath().name, output.url])
+                csv_writer.writerow(self.row(output))
 
     def read(self):
         with self.filepath().open('r', encoding='utf-8') as f:
@@ -42,12 +128,18 @@ class CSVMetadata(MetadataABC):
             for line in csv_reader:
                 yield line
 
+    def completed(self):
+        try:
+            for line in self.read():
+                if line[1] != '':
+                    yield line[2]
+        except FileNotFoundError:
+            return
+
     def clean(self, deep=True):
         try:
             if deep is True:
-                for _, filename, _ in self.read():
-                    path = self.basepath.joinpath(filename)
-                    path.unlink(True)
+                remove_files(self.basepath, {line[1] for line in self.read() if line[1] != ''})
             self.filepath().unlink()
         except FileNotFoundError:
             log.exception("File not Found")
@@ -57,6 +149,243 @@ class CSVMetadata(MetadataABC):
             csv_writer = csv.writer(f)
             csv_writer.writerow([name, '', url])
 
+    def merge(self, others: list):
+        with self.filepath().open('a', encoding='utf-8', newline='') as f:
+            csv_writer = csv.writer(f)
+            for other in others:
+                csv_writer.writerows(other.read())
+        for other in others:
+            other.clean(deep=False)
+
+
+class JournalMetadata(CSVMetadata):
+    def __init__(self, basepath: Path, flush_rows: int = 1000, flush_seconds: float = 1., fsync: bool = False,
+                 index: bool = True):
+        super(JournalMetadata, self).__init__(basepath)
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+        self.fsync = fsync
+        self.index = index
+        self.rows = []
+        self.file = None
+        self.csv_writer = None
+        self.db = None
+        self.last_flush = time.monotonic()
+        self.lock = threading.RLock()
+        # flushes buffered rows every flush_seconds while the journal is open, a stalled crawl included
+        self.timer = None
+        self.stopped = threading.Event()
+
+    def index_filepath(self) -> Path:
+        return self.basepath.joinpath(f'{self.filename}.db')
+
+    def open(self):
+        self.basepath.mkdir(parents=False, exist_ok=True)
+        self.file = self.filepath().open('a', encoding='utf-8', newline='')
+        self.csv_writer = csv.writer(self.file)
+        if self.index:
+            self.db = sqlite3.connect(str(self.index_filepath()), check_same_thread=False)
+            self.db.execute("CREATE TABLE IF NOT EXISTS metadata "
+                            "(id TEXT, url TEXT, length TEXT, filename TEXT, nbytes TEXT, offset TEXT)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS metadata_id ON metadata (id)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS metadata_url ON metadata (url)")
+        if self.flush_seconds is not None:
+            self.stopped.clear()
+            self.timer = threading.Thread(target=self.periodic, daemon=True)
+            self.timer.start()
+
+    def periodic(self):
+        while not self.stopped.wait(self.flush_seconds):
+            if time.monotonic() - self.last_flush >= self.flush_seconds:
+                try:
+                    self.flush()
+                except Exception:
+                    log.exception("Journal flush error")
+
+    def append(self, row: list):
+        with self.lock:
+            if self.file is None:
+                self.open()
+            self.rows.append(row)
+            if len(self.rows) >= self.flush_rows or \
+                    (self.flush_seconds is not None and time.monotonic() - self.last_flush >= self.flush_seconds):
+                self.flush()
+
+    def flush(self):
+        with self.lock:
+            if self.file is not None and len(self.rows) > 0:
+                self.csv_writer.writerows(self.rows)
+                self.file.flush()
+                if self.fsync:
+                    os.fsync(self.file.fileno())
+                if self.db is not None:
+                    self.db.executemany("INSERT INTO metadata VALUES (?, ?, ?, ?, ?, ?)",
+                                        ((str(uuid.uuid5(uuid.NAMESPACE_DNS, row[2])), row[2], row[0], row[1],
+                                          row[3], row[4]) for row in self.rows))
+                    self.db.commit()
+            self.rows = []
+            self.last_flush = time.monotonic()
+
+    def write(self, output):
+        if not output.is_empty():
+            self.append(self.row(output))
+
+    def error(self, name, url):
+        self.append([name, '', url, '', ''])
+
+    def merge(self, others: list):
+        for other in others:
+            for row in other.read():
+                self.append(row)
+            other.clean(deep=False)
+        self.flush()
+
+    def find(self, url: str = None, id: str = None) -> list:
+        self.flush()
+        if self.db is None:
+            return [line for line in self.read()
+                    if line[2] == url or (id is not None and str(uuid.uuid5(uuid.NAMESPACE_DNS, line[2])) == id)]
+        if url is not None:
+            cursor = self.db.execute("SELECT length, filename, url, nbytes, offset FROM metadata WHERE url = ?",
+                                     (url,))
+        else:
+            cursor = self.db.execute("SELECT length, filename, url, nbytes, offset FROM metadata WHERE id = ?",
+                                     (id,))
+        return [list(line) for line in cursor]
+
+    def read(self):
+        self.flush()
+        return super(JournalMetadata, self).read()
+
+    def close(self):
+        self.stopped.set()
+        if self.timer is not None and self.timer is not threading.current_thread():
+            self.timer.join()
+        self.timer = None
+        with self.lock:
+            self.flush()
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+    def clean(self, deep=True):
+        self.close()
+        if deep is True:
+            if self.index and self.index_filepath().exists():
+                db = sqlite3.connect(str(self.index_filepath()))
+                filenames = [filename for filename, in db.execute("SELECT DISTINCT filename FROM metadata")]
+                db.close()
+            else:
+                filenames = {line[1] for line in self.read()}
+            remove_files(self.basepath, (filename for filename in filenames if filename != ''))
+        self.index_filepath().unlink(True)
+        super(JournalMetadata, self).clean(deep=False)
+
+
+class Batch:
+    __slots__ = ('columns', 'index', 'data', 'length')
+
+    def __init__(self, columns: list = None):
+        self.columns = []
+        self.index = {}
+        self.data = []
+        self.length = 0
+        if columns is not None:
+            for name in columns:
+                self.add_column(name)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(columns={self.columns}, length={self.length})'
+
+    def __len__(self) -> int:
+        return self.length
+
+    @classmethod
+    def from_rows(cls, rows) -> 'Batch':
+        batch = cls()
+        batch.extend(rows)
+        return batch
+
+    @staticmethod
+    def new_column(value):
+        # numeric columns live in typed arrays, they fall back to a list on the first value that does not fit
+        if isinstance(value, bool) or value is None:
+            return []
+        elif isinstance(value, int):
+            return array.array('q')
+        elif isinstance(value, float):
+            return array.array('d')
+        else:
+            return []
+
+    def add_column(self, name, value=None):
+        self.index[name] = len(self.columns)
+        self.columns.append(name)
+        column = self.new_column(value) if self.length == 0 else [None] * self.length
+        self.data.append(column)
+
+    def push(self, i: int, value):
+        column = self.data[i]
+        if isinstance(column, array.array):
+            if column.typecode == 'q':
+                fits = isinstance(value, int) and not isinstance(value, bool)
+            else:
+                fits = isinstance(value, float)
+            if fits:
+                try:
+                    column.append(value)
+                    return
+                except OverflowError:
+                    pass
+            column = self.data[i] = list(column)
+        column.append(value)
+
+    def append(self, row):
+        if isinstance(row, dict):
+            for name, value in row.items():
+                if name not in self.index:
+                    self.add_column(name, value)
+            if len(row) == len(self.columns):
+                for name, value in row.items():
+                    self.push(self.index[name], value)
+            else:
+                for i, name in enumerate(self.columns):
+                    self.push(i, row.get(name))
+        else:
+            if not isinstance(row, (list, tuple)):
+                row = (row,)
+            for i in range(len(self.columns), len(row)):
+                self.add_column(f'col{i}', row[i])
+            for i in range(len(self.columns)):
+                self.push(i, row[i] if i < len(row) else None)
+        self.length += 1
+
+    def extend(self, rows):
+        for row in rows:
+            self.append(row)
+
+    def column(self, name):
+        return self.data[self.index[name]]
+
+    def rows(self):
+        return zip(*self.data)
+
+    def to_list(self) -> list:
+        return [dict(zip(self.columns, row)) for row in self.rows()]
+
+    def take(self, indexes: list) -> 'Batch':
+        # keeps the column types, typed arrays stay typed arrays
+        batch = Batch()
+        batch.columns = list(self.columns)
+        batch.index = dict(self.index)
+        batch.data = [array.array(column.typecode, (column[i] for i in indexes)) if isinstance(column, array.array)
+                      else [column[i] for i in indexes] for column in self.data]
+        batch.length = len(indexes)
+        return batch
+
 
 class Stream(StreamABC):
     @abstractmethod
@@ -73,14 +402,25 @@ class Stream(StreamABC):
             urllib.parse.urlparse(url)._replace(query=urllib.parse.urlencode(url_params)))
 
 
+def picklable_state(stream, iterator) -> dict:
+    # a worker process gets a copy of the stream, a generator can not be copied
+    if inspect.isgenerator(iterator):
+        raise Exception(f"{stream.__class__.__name__} over a one-shot generator can not be sent to another "
+                        f"process, use a list, a range, a FileStream or a TemplateStream")
+    return stream.__dict__.copy()
+
+
 class BaseStream(StreamABC):
     def __init__(self, seq):
-        if isinstance(seq, list) or isinstance(seq, tuple):
-            self.stream = iter(seq)
-        elif isinstance(seq, iter):
-            self.stream = seq
-        else:
-            self.stream = []
+        # any iterable, generators and ranges are consumed lazily, a str is a single url
+        if hasattr(seq, '__aiter__'):
+            raise Exception("async iterables are read through AsyncStream")
+        if isinstance(seq, str):
+            seq = (seq,)
+        self.stream = iter(seq)
+
+    def __getstate__(self):
+        return picklable_state(self, self.stream)
 
     def set_next(self, value):
         return next(self.stream)
@@ -89,6 +429,75 @@ class BaseStream(StreamABC):
         return self.set_next(None)
 
 
+class FileStream(BaseStream):
+    def __init__(self, filepath: Path, use_mmap: bool = False, buffering: int = 2**20, encoding: str = 'utf-8',
+                 offset: int = 0):
+        # one url per line, blank lines and lines starting with # are skipped
+        self.filepath = filepath
+        self.use_mmap = use_mmap
+        self.buffering = buffering
+        self.encoding = encoding
+        # byte offset of the next line
+        self.offset = offset
+        super(FileStream, self).__init__(self.lines())
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.filepath}, use_mmap={self.use_mmap})'
+
+    def __getstate__(self):
+        # the copy reopens the file and continues from the same line
+        return {'filepath': self.filepath, 'use_mmap': self.use_mmap, 'buffering': self.buffering,
+                'encoding': self.encoding, 'offset': self.offset}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def lines(self):
+        # the file is only opened on the first url
+        with self.filepath.open('rb', buffering=self.buffering) as f:
+            if self.use_mmap and os.fstat(f.fileno()).st_size > 0:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    mm.seek(self.offset)
+                    yield from self.decode(iter(mm.readline, b''))
+            elif not self.use_mmap:
+                f.seek(self.offset)
+                yield from self.decode(f)
+
+    def decode(self, lines):
+        for line in lines:
+            self.offset += len(line)
+            line = line.strip()
+            if len(line) > 0 and not line.startswith(b'#'):
+                yield line.decode(self.encoding)
+
+
+class AsyncStream(StreamABC):
+    def __init__(self, seq):
+        self.stream = seq.__aiter__()
+
+    def set_next(self, value):
+        pass
+
+    def __next__(self):
+        raise Exception("an async stream is read with anext")
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self.stream.__anext__()
+
+
+async def next_url(stream: StreamABC):
+    # None once the stream is depleted, StopIteration can not cross a coroutine
+    try:
+        if isinstance(stream, AsyncStream):
+            return await stream.__anext__()
+        return next(stream)
+    except (StopIteration, StopAsyncIteration):
+        return None
+
+
 class StreamPage(Stream):
     def __init__(self, resource, key, response_wait_key=None, **params):
         # {'pageIndex': 1, 'pageSize': 100}
@@ -101,6 +510,25 @@ class StreamPage(Stream):
     def set_next(self, value):
         self.url_params[self.key] = value
 
+    def page(self, url) -> int:
+        return int(dict(urllib.parse.parse_qsl(urllib.parse.urlparse(url).query)).get(self.key, 0))
+
+    def is_own(self, url) -> bool:
+        # the metadata can hold urls of other streams, only the pages of this template are restored
+        parsed = urllib.parse.urlparse(url)
+        params = dict(urllib.parse.parse_qsl(parsed.query))
+        params.pop(self.key, None)
+        own = {name: str(value) for name, value in self.url_params.items() if name != self.key}
+        return parsed._replace(query='') == urllib.parse.urlparse(self.url)._replace(query='') and params == own
+
+    def restore(self, url):
+        # continue after the highest completed page
+        if not self.is_own(url):
+            return
+        page = self.page(url)
+        if self.key not in self.url_params or int(self.url_params[self.key]) < page:
+            self.url_params[self.key] = page
+
     def __next__(self):
         try:
             self.set_next(int(self.url_params[self.key]) + 1)
@@ -116,6 +544,39 @@ class StreamPageWait(StreamPage):
     def __next__(self):
         return self.build_url(self.url, self.url_params)
 
+    def restore(self, url):
+        # the next cursor only comes in the response headers, so the last completed page is requested
+        # again, Request.accept takes its cursor without storing it twice
+        if not self.is_own(url):
+            return
+        value = dict(urllib.parse.parse_qsl(urllib.parse.urlparse(url).query)).get(self.key)
+        if value is None:
+            self.url_params.pop(self.key, None)
+        else:
+            self.url_params[self.key] = value
+
+
+class TemplateStream(Stream):
+    def __init__(self, resource, key, values, **params):
+        # values is any iterable, a range of ids is expanded one url at a time
+        self.url = resource
+        self.key = key
+        self.url_params = params
+        self.values = iter(values)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.url}, key={self.key})'
+
+    def __getstate__(self):
+        return picklable_state(self, self.values)
+
+    def set_next(self, value):
+        self.url_params[self.key] = value
+
+    def __next__(self):
+        self.set_next(next(self.values))
+        return self.build_url(self.url, self.url_params)
+
 
 class BuffStream:
     def __init__(self, stream: StreamABC = None, buff_size: int = 5):
@@ -142,60 +603,804 @@ class BuffStream:
         else:
             raise StopIteration
 
+    async def abatch(self) -> list:
+        # same batches as __next__, async streams included, an empty batch once depleted
+        buff = []
+        while len(buff) < self.buff_size:
+            url = await next_url(self.stream)
+            if url is None:
+                break
+            buff.append(url)
+        return buff
+
+
+class DigestSet:
+    def __init__(self, urls=None, capacity: int = 1024):
+        # open addressing over an array of 8 byte digests, 0 marks a free slot and the table
+        # stays 35-70% full, ~12-24 bytes per url where a set of ints takes ~60
+        # slots are masked with capacity - 1, so it is rounded up to a power of two
+        capacity = 1 << (max(capacity, 2) - 1).bit_length()
+        self.table = array.array('Q', bytes(8 * capacity))
+        self.count = 0
+        if urls is not None:
+            for url in urls:
+                self.add(url)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({len(self)})'
+
+    @staticmethod
+    def digest(url: str) -> int:
+        return int.from_bytes(hashlib.blake2b(url.encode('utf-8'), digest_size=8).digest(), 'little')
+
+    def slot(self, digest: int) -> int:
+        # the digest is uniform, its low bits are the home slot, linear probing from there
+        mask = len(self.table) - 1
+        i = digest & mask
+        while self.table[i] != 0 and self.table[i] != digest:
+            i = (i + 1) & mask
+        return i
+
+    def grow(self):
+        table = self.table
+        self.table = array.array('Q', bytes(16 * len(table)))
+        for digest in table:
+            if digest != 0:
+                self.table[self.slot(digest)] = digest
+
+    def add(self, url: str):
+        digest = self.digest(url) or 1
+        i = self.slot(digest)
+        if self.table[i] == 0:
+            self.table[i] = digest
+            self.count += 1
+            if self.count * 10 >= len(self.table) * 7:
+                self.grow()
+
+    def __contains__(self, url: str) -> bool:
+        digest = self.digest(url) or 1
+        return self.table[self.slot(digest)] == digest
+
+    def __len__(self) -> int:
+        return self.count
+
+
+class SessionPool:
+    def __init__(self, limit: int = 100, limit_per_host: int = 0, keepalive_timeout: float = 15,
+                 ttl_dns_cache: int = 10, session: aiohttp.ClientSession = None, **session_kwargs):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.ttl_dns_cache = ttl_dns_cache
+        self.session = session
+        self.session_kwargs = session_kwargs
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(limit={self.limit}, limit_per_host={self.limit_per_host})'
+
+    def connector(self) -> aiohttp.TCPConnector:
+        return aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit_per_host,
+                                    keepalive_timeout=self.keepalive_timeout,
+                                    ttl_dns_cache=self.ttl_dns_cache, use_dns_cache=True)
+
+    @asynccontextmanager
+    async def open(self, trace_configs: list = None):
+        # an injected session belongs to the caller, so it is never closed here
+        if self.session is not None:
+            if trace_configs:
+                log.debug("trace configs can not be added to an injected session")
+            yield self.session
+        else:
+            kwargs = dict(self.session_kwargs)
+            if trace_configs:
+                kwargs['trace_configs'] = list(kwargs.get('trace_configs', [])) + trace_configs
+            async with aiohttp.ClientSession(connector=self.connector(), **kwargs) as session:
+                yield session
+
+
+class DomainLimit:
+    def __init__(self, limit: float):
+        self.limit = limit
+        self.in_flight = 0
+        self.latency = None
+        self.min_latency = None
+        self.last_decrease = 0.
+        self.condition = None
+        self.loop = None
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(limit={self.limit:.2f}, in_flight={self.in_flight})'
+
+    def wait_condition(self) -> asyncio.Condition:
+        # a condition is bound to the loop it first waits in and every Request.run starts a new one
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            self.condition = asyncio.Condition()
+            self.loop = loop
+        return self.condition
+
+
+class AIMDController:
+    congestion_errors = (aiohttp.ServerDisconnectedError, asyncio.exceptions.TimeoutError)
+
+    def __init__(self, initial: int = 4, minimum: int = 1, maximum: int = 64, increase: float = 1.,
+                 decrease: float = .5, latency_factor: float = 2., statuses: tuple = (429, 503)):
+        self.initial = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_factor = latency_factor
+        self.statuses = statuses
+        self.domains = {}
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.limits()})'
+
+    @staticmethod
+    def domain(url) -> str:
+        return urllib.parse.urlparse(str(url)).netloc
+
+    def state(self, domain: str) -> DomainLimit:
+        if domain not in self.domains:
+            self.domains[domain] = DomainLimit(self.initial)
+        return self.domains[domain]
+
+    def limits(self) -> dict:
+        return {domain: int(state.limit) for domain, state in self.domains.items()}
+
+    def success(self, domain: str, latency: float):
+        state = self.state(domain)
+        state.latency = latency if state.latency is None else .8 * state.latency + .2 * latency
+        state.min_latency = latency if state.min_latency is None else min(state.min_latency, latency)
+        # one additive step per window of successful requests while latency stays near its floor
+        if state.latency <= state.min_latency * self.latency_factor:
+            state.limit = min(self.maximum, state.limit + self.increase / state.limit)
+
+    def congestion(self, domain: str):
+        state = self.state(domain)
+        now = time.monotonic()
+        # requests already in flight report the same congestion event, only the first one counts
+        if now - state.last_decrease >= (state.latency or 0.):
+            state.limit = max(self.minimum, state.limit * self.decrease)
+            state.last_decrease = now
+            log.debug(f"{domain} limit cut to {state.limit:.2f}")
+
+    @asynccontextmanager
+    async def slot(self, url):
+        domain = self.domain(url)
+        state = self.state(domain)
+        condition = state.wait_condition()
+        async with condition:
+            await condition.wait_for(lambda: state.in_flight < int(state.limit))
+            state.in_flight += 1
+        start = time.monotonic()
+        try:
+            yield
+        except self.congestion_errors:
+            self.congestion(domain)
+            raise
+        else:
+            # a 429/503 seen by the trace config during this request is not a success
+            if state.last_decrease < start:
+                self.success(domain, time.monotonic() - start)
+        finally:
+            async with condition:
+                state.in_flight -= 1
+                condition.notify_all()
+
+    def trace_config(self) -> aiohttp.TraceConfig:
+        async def on_request_end(session, context, params):
+            if params.response.status in self.statuses:
+                self.congestion(self.domain(params.url))
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_end.append(on_request_end)
+        return trace_config
+
+
+def persist(output, compression=None, sink=None, metrics=None, **kwargs):
+    start = time.monotonic()
+    output.write_buff(**kwargs)
+    target = output
+    if compression is not None:
+        target = compression(output)
+        target.write_buff()
+    if sink is None:
+        target.write_disk()
+    else:
+        sink.write(target)
+    if metrics is not None:
+        metrics.written(target, time.monotonic() - start)
+    return target
+
+
+class WriterPool:
+    def __init__(self, workers: int = 4, executor: str = 'thread', maxsize: int = None):
+        if executor not in ('thread', 'process'):
+            raise Exception(f"unknown executor {executor}")
+        self.workers = workers
+        self.executor_type = executor
+        self.maxsize = workers * 2 if maxsize is None else maxsize
+        self.queue = None
+        self.executor = None
+        self.journal = None
+        self.metrics = None
+        self.tasks = []
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.executor_type}, workers={self.workers})'
+
+    def start(self, metadata: MetadataABC, compression=None, clean: bool = False, sink=None, metrics=None,
+              **kwargs):
+        if self.executor_type == 'process':
+            if sink is not None:
+                raise Exception("a sink keeps its file open and can only be shared by thread writers")
+            self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        else:
+            self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        # metadata rows are appended from a single thread so they never interleave
+        self.journal = ThreadPoolExecutor(max_workers=1)
+        self.queue = asyncio.Queue(maxsize=self.maxsize)
+        self.metrics = metrics
+        self.tasks = [asyncio.create_task(self.consume(metadata, compression, clean, sink, kwargs))
+                      for _ in range(self.workers)]
+
+    async def put(self, output):
+        # blocks the caller while the queue is full, which throttles fetching
+        await self.queue.put((output, time.monotonic()))
+        self.gauge()
+
+    def gauge(self):
+        # updated on both ends of the queue, so it drops while the writers drain
+        if self.metrics is not None:
+            self.metrics.gauge('writer_queue_depth', self.queue.qsize())
+
+    async def consume(self, metadata: MetadataABC, compression, clean: bool, sink, kwargs: dict):
+        loop = asyncio.get_running_loop()
+        while True:
+            output, queued = await self.queue.get()
+            self.gauge()
+            try:
+                start = time.monotonic()
+                output = await loop.run_in_executor(
+                    self.executor, functools.partial(persist, output, compression=compression, sink=sink, **kwargs))
+                await loop.run_in_executor(self.journal, metadata.write, output)
+                if clean:
+                    await loop.run_in_executor(self.journal, output.clean)
+                if self.metrics is not None:
+                    # measured here since a process writer can not update the metrics of this process
+                    end = time.monotonic()
+                    self.metrics.written(output, end - start)
+                    self.metrics.observe('writer_lag', self.metrics.domain(output.url), end - queued)
+            except Exception:
+                log.exception(f"Writer error {output.url}")
+            finally:
+                self.queue.task_done()
+
+    async def close(self):
+        await self.queue.join()
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        self.executor.shutdown()
+        self.journal.shutdown()
+
+
+class RetryPolicy:
+    errors = (aiohttp.ServerDisconnectedError, aiohttp.client_exceptions.ClientConnectorError,
+              asyncio.exceptions.TimeoutError)
+
+    def __init__(self, attempts: dict = None, base: float = .1, cap: float = 10., deadline: float = None):
+        # error class -> number of retries allowed
+        if attempts is None:
+            attempts = {aiohttp.ServerDisconnectedError: 3, aiohttp.client_exceptions.ClientConnectorError: 3,
+                        asyncio.exceptions.TimeoutError: 1}
+        self.attempts = attempts
+        self.base = base
+        self.cap = cap
+        self.deadline = deadline
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(base={self.base}, cap={self.cap}, deadline={self.deadline})'
+
+    def retries(self, error) -> int:
+        for error_class, retries in self.attempts.items():
+            if isinstance(error, error_class):
+                return retries
+        return 0
+
+    def delay(self, error, attempt: int, elapsed: float):
+        if attempt > self.retries(error):
+            return None
+        # full jitter keeps the retries of a failed batch from arriving together
+        delay = random.uniform(0, min(self.cap, self.base * 2 ** attempt))
+        if self.deadline is not None and elapsed + delay >= self.deadline:
+            return None
+        return delay
+
+
+class Hedge:
+    # hedging is meant for window(), prefetch() and pipeline(), which yield tasks as they finish; a get() batch
+    # is cut by the output() timeout, so a hedged straggler past it is dropped like any other slow request
+    def __init__(self, percentile: float = .95, min_samples: int = 20, window: int = 1000, refresh: int = 50):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.latencies = collections.deque(maxlen=window)
+        # the percentile is recomputed every `refresh` samples instead of on every request
+        self.refresh = refresh
+        self.cached = None
+        self.stale = 0
+        self.hedged = 0
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(percentile={self.percentile}, hedged={self.hedged})'
+
+    def observe(self, latency: float):
+        self.latencies.append(latency)
+        self.stale += 1
+
+    def delay(self):
+        if len(self.latencies) < self.min_samples:
+            return None
+        if self.cached is None or self.stale >= self.refresh:
+            latencies = sorted(self.latencies)
+            self.cached = latencies[min(int(len(latencies) * self.percentile), len(latencies) - 1)]
+            self.stale = 0
+        return self.cached
+
 
 class Request:
-    def __init__(self, buff: BuffStream, metadata: MetadataABC):
+    def __init__(self, buff: BuffStream, metadata: MetadataABC, pool: SessionPool = None, resume: bool = False,
+                 cache=None, controller: AIMDController = None, retry: RetryPolicy = None, hedge: Hedge = None,
+                 metrics=None, dedup=None):
         self.buff = buff
         self.is_buff_depleted = False
         self.metadata = metadata
+        self.pool = SessionPool() if pool is None else pool
+        self.cache = cache
+        self.controller = controller
+        self.retry = retry
+        self.hedge = hedge
+        self.metrics = metrics
+        self.dedup = dedup
+        self.is_pipelined = False
+        self.cursors = {}
+        self.completed = None
+        # stream position of every request, only kept while outputs() runs in stream order
+        self.is_ordered = False
+        self.issued = 0
+        self.order = {}
+        self.order_tasks = {}
+        self.skipped = set()
+        if resume:
+            self.restore()
 
-    async def except_fn(self, callback, session, url, headers, timeout):
-        try:
+    def restore(self):
+        self.completed = DigestSet()
+        for url in self.metadata.completed():
+            self.completed.add(url)
+            self.buff.stream.restore(url)
+        log.info(f"Resuming, {len(self.completed)} urls already completed")
+
+    def is_completed(self, url) -> bool:
+        # cursor streams must fetch again the page that carries the next cursor
+        return self.completed is not None and self.buff.stream.response_wait_key is None \
+            and url in self.completed
+
+    def trace_configs(self) -> list:
+        trace_configs = []
+        if self.controller is not None:
+            trace_configs.append(self.controller.trace_config())
+        if self.metrics is not None:
+            trace_configs.append(self.metrics.trace_config())
+        if self.is_pipelined:
+            trace_configs.append(self.cursor_trace_config())
+        return trace_configs
+
+    def cursor_trace_config(self) -> aiohttp.TraceConfig:
+        # on_request_end fires once the response headers arrived, before the body is read
+        async def on_request_end(session, context, params):
+            event = self.cursors.pop(params.url, None)
+            if event is not None:
+                cursor = params.response.headers.get(self.buff.stream.response_wait_key)
+                if cursor is not None:
+                    self.buff.stream.set_next(cursor)
+                    event.set()
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_end.append(on_request_end)
+        return trace_config
+
+    @asynccontextmanager
+    async def session(self):
+        async with self.pool.open(trace_configs=self.trace_configs()) as session:
+            if self.cache is not None:
+                try:
+                    yield self.cache.wrap(session)
+                finally:
+                    # the bodies are already on disk, the index is kept even when the run fails
+                    self.cache.save()
+            else:
+                yield session
+
+    async def hedged(self, callback, session, url, headers, timeout):
+        if self.hedge is None:
             return await callback(session, url, headers, timeout)
-        except aiohttp.ServerDisconnectedError:
+        # only meant for callbacks that build their output in memory, a hedged duplicate
+        # of a callback writing to disk would race on the same file
+        delay = self.hedge.delay()
+        start = time.monotonic()
+        tasks = {asyncio.create_task(callback(session, url, headers, timeout))}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if len(done) == 0:
+                tasks.add(asyncio.create_task(callback(session, url, headers, timeout)))
+                self.hedge.hedged += 1
+            pending = set(tasks)
+            while True:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        self.hedge.observe(time.monotonic() - start)
+                        return task.result()
+                if len(pending) == 0:
+                    return done.pop().result()
+        finally:
+            await self.drain(tasks)
+
+    async def attempt(self, callback, session, url, headers, timeout, deadline: float = None):
+        coro = self.hedged(callback, session, url, headers, timeout)
+        if deadline is not None:
+            coro = asyncio.wait_for(coro, timeout=max(deadline - time.monotonic(), 0))
+        if self.controller is not None:
+            async with self.controller.slot(url):
+                return await coro
+        return await coro
+
+    async def except_fn(self, callback, session, url, headers, timeout):
+        if self.is_ordered:
+            # tasks take their first step in creation order, which is the order urls left the stream
+            task = asyncio.current_task()
+            self.order[task] = self.issued
+            self.order_tasks[self.issued] = task
+            self.issued += 1
+        start = time.monotonic()
+        deadline = None
+        if self.retry is not None and self.retry.deadline is not None:
+            deadline = start + self.retry.deadline
+        attempt = 0
+        while True:
+            try:
+                output = await self.attempt(callback, session, url, headers, timeout, deadline=deadline)
+                if self.metrics is not None:
+                    # request plus the callback parsing, retries included
+                    self.metrics.observe('total', self.metrics.domain(url), time.monotonic() - start)
+                return output
+            except RetryPolicy.errors as e:
+                attempt += 1
+                delay = None if self.retry is None else self.retry.delay(e, attempt, time.monotonic() - start)
+                if delay is None:
+                    self.fail(e, url)
+                    return None
+                log.debug(f"Retry {attempt} {url} in {delay:.2f}s")
+                await asyncio.sleep(delay)
+
+    def fail(self, error, url):
+        # every request given up on leaves an error row, so error counts cover each failure class
+        if isinstance(error, aiohttp.ServerDisconnectedError):
             self.metadata.error("timeout", url)
             log.info("Server disconnected")
-        except aiohttp.client_exceptions.ClientConnectorError:
+        elif isinstance(error, aiohttp.client_exceptions.ClientConnectorError):
+            self.metadata.error("connection", url)
             log.info("CLIENT EXCEPTION")
-        except asyncio.exceptions.TimeoutError:
+        else:
+            self.metadata.error("timeout", url)
             log.info(f"Request timeout")
 
+    @staticmethod
+    async def drain(tasks):
+        # cancels the stragglers and retrieves every exception before the session closes
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
     async def get(self, headers=None, callback=None, timeout=20):
-        for batch in self.buff:
-            async with aiohttp.ClientSession() as session:
-                tasks = [asyncio.create_task(self.except_fn(callback, session, url, headers, timeout))
-                         for url in batch]
-                yield tasks
-                if self.is_buff_depleted is True:
-                    break
+        if self.hedge is not None:
+            log.warning("hedged requests of a get() batch are dropped past the output() timeout, use window()")
+        tasks = []
+        # stragglers of earlier batches left behind by the output() timeout
+        pending = set()
+        async with self.session() as session:
+            try:
+                while True:
+                    batch = await self.buff.abatch()
+                    if len(batch) == 0:
+                        break
+                    tasks = [asyncio.create_task(self.except_fn(callback, session, url, headers, timeout))
+                             for url in batch if not self.is_completed(url)]
+                    yield tasks
+                    pending = {task for task in pending.union(tasks) if not task.done()}
+                    if self.is_buff_depleted is True:
+                        break
+            finally:
+                await self.drain(pending.union(tasks))
 
-    async def output(self, coro, clean: bool = False, timeout=5, compression=None, **kwargs):
-        tasks = coro
-        async for task_b in tasks:
-            for task in asyncio.as_completed(task_b, timeout=timeout):
-                try:
-                    output = await task
-                    if output is None:
-                        pass
+    async def window(self, headers=None, callback=None, timeout=20, size: int = None):
+        # keeps `size` requests in flight and yields them as they complete, so a slow
+        # response only holds its own slot instead of the whole batch
+        stream = self.buff.stream
+        size = self.buff.buff_size if size is None else size
+        if self.controller is not None:
+            # the controller decides how many of these reach the network, up to its maximum
+            size = max(size, self.controller.maximum)
+        if stream.response_wait_key is not None:
+            size = 1
+        pending = set()
+        done = set()
+        is_stream_depleted = False
+        async with self.session() as session:
+            try:
+                while True:
+                    while not (self.is_buff_depleted or is_stream_depleted) and len(pending) < size:
+                        url = await next_url(stream)
+                        if url is None:
+                            is_stream_depleted = True
+                        elif not self.is_completed(url):
+                            pending.add(asyncio.create_task(
+                                self.except_fn(callback, session, url, headers, timeout)))
+                    if len(pending) == 0:
+                        break
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    yield list(done)
+            finally:
+                await self.drain(pending | done)
+
+    async def prefetch(self, headers=None, callback=None, timeout=20, size: int = 2, maximum: int = 32,
+                       page_size: int = None):
+        # speculative window for StreamPage: grows by one slot per full page (doubling every round trip)
+        # and once an empty or short page marks the end, the requests past it are cancelled
+        stream = self.buff.stream
+        if not isinstance(stream, StreamPage) or stream.response_wait_key is not None:
+            raise Exception("prefetch needs a StreamPage without response_wait_key")
+        initial = size
+        pending = {}
+        end = None
+        async with self.session() as session:
+            try:
+                while True:
+                    while not self.is_buff_depleted and len(pending) < size:
+                        url = next(stream)
+                        if self.is_completed(url):
+                            continue
+                        task = asyncio.create_task(self.except_fn(callback, session, url, headers, timeout))
+                        pending[task] = stream.page(url)
+                    if len(pending) == 0:
+                        break
+                    done, _ = await asyncio.wait(pending.keys(), return_when=asyncio.FIRST_COMPLETED)
+                    pages = {task: pending.pop(task) for task in done}
+                    for task, page in pages.items():
+                        output = task.result()
+                        if output is None:
+                            continue
+                        if output.is_empty():
+                            end = page if end is None else min(end, page)
+                        elif page_size is not None and output.length() < page_size:
+                            end = page + 1 if end is None else min(end, page + 1)
+                        else:
+                            size = min(maximum, size + 1)
+                    beyond = []
+                    if end is not None:
+                        self.is_buff_depleted = True
+                        size = initial
+                        beyond = [task for task, page in pending.items() if page >= end]
+                        for task in beyond:
+                            del pending[task]
+                        await self.drain(beyond)
+                    tasks = [task for task, page in pages.items()
+                             if (end is None or page < end) and task.result() is not None
+                             and not task.result().is_empty()]
+                    self.discard([task for task in pages if task not in tasks] + beyond)
+                    if len(tasks) > 0:
+                        yield tasks
+            finally:
+                await self.drain(list(pending))
+
+    async def pipeline(self, headers=None, callback=None, timeout=20, size: int = 4):
+        # issues the next cursor page as soon as the headers of the current one arrive, so the body
+        # download, parsing and writing of a page overlap with the fetch of the following pages
+        stream = self.buff.stream
+        if stream.response_wait_key is None:
+            raise Exception("pipeline needs a stream with response_wait_key")
+        self.is_pipelined = True
+        pending = {}
+        seq = 0
+        event = None
+        is_cursor_ready = True
+        async with self.session() as session:
+            try:
+                while True:
+                    if is_cursor_ready and not self.is_buff_depleted and len(pending) < size:
+                        url = next(stream)
+                        event = asyncio.Event()
+                        self.cursors[yarl.URL(url)] = event
+                        task = asyncio.create_task(self.except_fn(callback, session, url, headers, timeout))
+                        pending[task] = seq
+                        seq += 1
+                        is_cursor_ready = False
+                    if len(pending) == 0:
+                        break
+                    if is_cursor_ready:
+                        # the window is full, only a finished page frees a slot
+                        done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
                     else:
-                        if self.buff.stream.response_wait_key is not None:
-                            self.buff.stream.set_next(output.headers.get(self.buff.stream.response_wait_key))
-                        if output.content is None or len(output.content) == 0:
-                            self.is_buff_depleted = True
-                        output.write_buff(**kwargs)
-                        if compression is not None:
-                            compression(output)
-                            compression.write_disk()
-                            self.metadata.write(compression)
-                            output.buffer = None
+                        waiter = asyncio.create_task(event.wait())
+                        done, _ = await asyncio.wait(set(pending) | {waiter}, return_when=asyncio.FIRST_COMPLETED)
+                        if waiter in done:
+                            is_cursor_ready = True
+                            done.discard(waiter)
                         else:
-                            output.write_disk()
-                            self.metadata.write(output)
-                        # output.close()
-                        if clean:
-                            output.clean()
-                except asyncio.exceptions.TimeoutError:
-                    log.info(f"Async Request timeout")
+                            await self.drain([waiter])
+                    seqs = {task: pending.pop(task) for task in done}
+                    end = None
+                    beyond = []
+                    for task in sorted(done, key=seqs.get):
+                        output = task.result()
+                        if output is None:
+                            continue
+                        if seqs[task] == seq - 1 and not is_cursor_ready:
+                            # the cursor was not seen by the trace config, e.g. on an injected session
+                            cursor = output.headers.get(stream.response_wait_key)
+                            if cursor is not None:
+                                stream.set_next(cursor)
+                                is_cursor_ready = True
+                        if output.is_empty():
+                            end = seqs[task]
+                            self.is_buff_depleted = True
+                            beyond = [t for t, n in pending.items() if n > end]
+                            for t in beyond:
+                                del pending[t]
+                            await self.drain(beyond)
+                            break
+                    tasks = [task for task in done if (end is None or seqs[task] < end)
+                             and task.result() is not None and not task.result().is_empty()]
+                    self.discard([task for task in done if task not in tasks] + beyond)
+                    if len(tasks) > 0:
+                        yield tasks
+            finally:
+                self.is_pipelined = False
+                self.cursors = {}
+                await self.drain(list(pending))
+
+    def discard(self, tasks: list):
+        # tasks a scheduler will never yield, outputs() in stream order skips over their position
+        if self.is_ordered:
+            for task in tasks:
+                position = self.order.pop(task, None)
+                if position is not None:
+                    self.skipped.add(position)
+
+    def accept(self, output) -> bool:
+        # False when there is nothing to store
+        if output is None:
+            return False
+        if self.buff.stream.response_wait_key is not None and not self.is_pipelined:
+            self.buff.stream.set_next(output.headers.get(self.buff.stream.response_wait_key))
+        if self.buff.stream.response_wait_key is not None and self.completed is not None \
+                and output.url in self.completed:
+            # a cursor page fetched again on resume only to read the next cursor, it is already stored
+            return False
+        if output.is_empty():
+            self.is_buff_depleted = True
+        elif self.dedup is not None:
+            # a page made only of rows already stored is not the end of the stream
+            self.dedup.filter(output)
+            return not output.is_empty()
+        return True
+
+    async def outputs(self, coro, size: int = 16, ordered: bool = False, records: bool = False):
+        # yields the outputs instead of writing them, fetching runs ahead by at most `size` outputs
+        # and a slow consumer holds it back
+        queue = asyncio.Queue(maxsize=size)
+        end = object()
+        self.is_ordered = ordered
+
+        async def produce():
+            position = 0
+            waiting = {}
+            try:
+                async for task_b in coro:
+                    if ordered:
+                        for task in task_b:
+                            output = await task
+                            waiting[self.order.pop(task)] = output if self.accept(output) else None
+                        while position in waiting or position in self.skipped:
+                            self.order_tasks.pop(position, None)
+                            self.skipped.discard(position)
+                            output = waiting.pop(position, None)
+                            position += 1
+                            if output is not None and not output.is_empty():
+                                await queue.put(output)
+                        # a slow head of line holds back the stream instead of growing the reorder buffer
+                        head = self.order_tasks.get(position)
+                        if len(waiting) >= size and head is not None and not head.done():
+                            await asyncio.wait({head})
+                    else:
+                        for task in asyncio.as_completed(task_b):
+                            output = await task
+                            if self.accept(output) and not output.is_empty():
+                                await queue.put(output)
+                # requests cancelled past the end of a page stream leave gaps behind
+                for key in sorted(waiting):
+                    if waiting[key] is not None and not waiting[key].is_empty():
+                        await queue.put(waiting[key])
+                await queue.put(end)
+            except Exception as e:
+                await queue.put(e)
+            finally:
+                await coro.aclose()
+
+        if self.metrics is not None:
+            self.metrics.start()
+        producer = asyncio.create_task(produce())
+        try:
+            while True:
+                output = await queue.get()
+                if output is end:
+                    break
+                elif isinstance(output, Exception):
+                    raise output
+                yield output.content if records else output
+        finally:
+            producer.cancel()
+            await asyncio.gather(producer, return_exceptions=True)
+            self.is_ordered = False
+            self.order = {}
+            self.order_tasks = {}
+            self.skipped = set()
+            if self.dedup is not None:
+                self.dedup.save()
+            if self.metrics is not None:
+                await self.metrics.stop()
+
+    async def output(self, coro, clean: bool = False, timeout=5, compression=None, writer: WriterPool = None,
+                     sink=None, **kwargs):
+        if writer is not None:
+            writer.start(self.metadata, compression=compression, clean=clean, sink=sink, metrics=self.metrics,
+                         **kwargs)
+        if self.metrics is not None:
+            self.metrics.start()
+        tasks = coro
+        try:
+            async for task_b in tasks:
+                for task in asyncio.as_completed(task_b, timeout=timeout):
+                    try:
+                        output = await task
+                        if self.accept(output):
+                            if writer is None:
+                                output = persist(output, compression=compression, sink=sink, metrics=self.metrics,
+                                                 **kwargs)
+                                self.metadata.write(output)
+                                if clean:
+                                    output.clean()
+                            else:
+                                await writer.put(output)
+                    except asyncio.exceptions.TimeoutError:
+                        log.info(f"Async Request timeout")
+        finally:
+            # closes the session even when a callback raised
+            await tasks.aclose()
+        if writer is not None:
+            await writer.close()
+        if sink is not None:
+            sink.close()
+        self.metadata.close()
+        if self.dedup is not None:
+            self.dedup.save()
+            log.info(f"Dedup dropped {self.dedup.hits} of {self.dedup.records} records")
+        if self.metrics is not None:
+            await self.metrics.stop()
 
     @staticmethod
     def run(output):
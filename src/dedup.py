@@ -0,0 +1,141 @@
+import logging
+import hashlib
+import math
+import os
+import struct
+from pathlib import Path
+from .core import Batch
+
+
+log = logging.getLogger(__file__)
+log_handler = logging.StreamHandler()
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+log_handler.setFormatter(formatter)
+log.addHandler(log_handler)
+log.setLevel(logging.INFO)
+
+
+class BloomFilter:
+    header = struct.Struct('<QQQ')
+
+    def __init__(self, capacity: int = 10**7, error_rate: float = 1e-4):
+        # 10M records at 1e-4 take ~23MB no matter how many records are added
+        self.nbits = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.nhashes = max(1, round(self.nbits / capacity * math.log(2)))
+        self.bits = bytearray((self.nbits + 7) // 8)
+        self.count = 0
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(nbits={self.nbits}, nhashes={self.nhashes}, count={self.count})'
+
+    def __len__(self) -> int:
+        return self.count
+
+    def positions(self, data: bytes):
+        # double hashing, two 64 bit halves of one digest give every position
+        digest = hashlib.blake2b(data, digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.nbits for i in range(self.nhashes)]
+
+    def __contains__(self, data: bytes) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.positions(data))
+
+    def add(self, data: bytes) -> bool:
+        # returns True when the data was (probably) already there
+        seen = True
+        for position in self.positions(data):
+            mask = 1 << (position & 7)
+            if not self.bits[position >> 3] & mask:
+                self.bits[position >> 3] |= mask
+                seen = False
+        if not seen:
+            self.count += 1
+        return seen
+
+    def dump(self, f):
+        f.write(self.header.pack(self.nbits, self.nhashes, self.count))
+        f.write(self.bits)
+
+    def load(self, f):
+        nbits, nhashes, count = self.header.unpack(f.read(self.header.size))
+        if nbits != self.nbits or nhashes != self.nhashes:
+            raise Exception(f"bloom filter was saved with {nbits} bits and {nhashes} hashes, "
+                            f"expected {self.nbits} and {self.nhashes}")
+        f.readinto(self.bits)
+        self.count = count
+
+
+class Dedup:
+    filename = 'dedup.bloom'
+
+    def __init__(self, basepath: Path, keys: list = None, capacity: int = 10**7, error_rate: float = 1e-4):
+        self.basepath = basepath.resolve()
+        self.keys = keys
+        self.bloom = BloomFilter(capacity=capacity, error_rate=error_rate)
+        self.records = 0
+        self.hits = 0
+        self.load()
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.basepath}, keys={self.keys}, hit_rate={self.hit_rate():.4f})'
+
+    def filepath(self) -> Path:
+        return self.basepath.joinpath(self.filename)
+
+    def load(self):
+        try:
+            with self.filepath().open('rb') as f:
+                self.bloom.load(f)
+        except FileNotFoundError:
+            pass
+
+    def save(self):
+        # written aside and renamed, a crash never leaves a truncated filter behind
+        self.basepath.mkdir(parents=True, exist_ok=True)
+        tmp_filepath = self.filepath().with_name(f'{self.filename}.tmp')
+        with tmp_filepath.open('wb') as f:
+            self.bloom.dump(f)
+        os.replace(tmp_filepath, self.filepath())
+
+    def clean(self):
+        self.filepath().unlink(True)
+
+    def key(self, record) -> bytes:
+        if isinstance(record, dict):
+            if self.keys is None:
+                # a Batch pads missing columns with None, so None values are left out of the key
+                record = sorted((name, value) for name, value in record.items() if value is not None)
+            else:
+                record = [record.get(key) for key in self.keys]
+        return repr(record).encode('utf-8')
+
+    def is_seen(self, record) -> bool:
+        self.records += 1
+        seen = self.bloom.add(self.key(record))
+        if seen:
+            self.hits += 1
+        return seen
+
+    def hit_rate(self) -> float:
+        return self.hits / self.records if self.records > 0 else 0.
+
+    def filter(self, output):
+        # drops the records already seen in this or a previous run, rows repeated inside a page included
+        content = output.content
+        if isinstance(content, Batch):
+            if self.keys is None:
+                # same key as the equivalent dict, built from the columns present in the row
+                names = sorted(content.columns)
+                indexes = [content.index[name] for name in names]
+                records = ([(name, row[i]) for name, i in zip(names, indexes) if row[i] is not None]
+                           for row in content.rows())
+            else:
+                indexes = [content.index.get(key) for key in self.keys]
+                records = ([None if i is None else row[i] for i in indexes] for row in content.rows())
+            kept = [i for i, record in enumerate(records) if not self.is_seen(record)]
+            if len(kept) < len(content):
+                output.content = content.take(kept)
+        elif isinstance(content, list):
+            output.content = [record for record in content if not self.is_seen(record)]
+        return output
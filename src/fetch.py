@@ -0,0 +1,150 @@
+import logging
+import asyncio
+import json
+from pathlib import Path
+from .io import RawOutput, PassthroughOutput, Codec, CsvOutput
+from .core import Batch, Layout
+
+
+log = logging.getLogger(__file__)
+log_handler = logging.StreamHandler()
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+log_handler.setFormatter(formatter)
+log.addHandler(log_handler)
+log.setLevel(logging.INFO)
+
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+    log.debug("orjson is not installed")
+
+
+def loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+class StreamFetch:
+    def __init__(self, basepath: Path, chunk_size: int = 2**16, file_extension: str = None,
+                 codec: Codec = None, layout: Layout = None):
+        self.basepath = basepath
+        self.chunk_size = chunk_size
+        self.file_extension = file_extension
+        self.codec = codec
+        self.layout = layout
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(chunk_size={self.chunk_size})'
+
+    async def __call__(self, session, url, headers, timeout):
+        async with session.get(url, headers=headers, timeout=timeout) as response:
+            output = RawOutput(url, headers=response.headers, basepath=self.basepath,
+                               file_extension=self.file_extension, codec=self.codec, layout=self.layout)
+            if response.status == 200:
+                await output.write_stream(response.content, chunk_size=self.chunk_size)
+            else:
+                log.info(f"Status {response.status} {url}")
+            return output
+
+
+class PassthroughFetch:
+    content_encodings = {'gzip': 'gzip', 'zlib': 'deflate'}
+
+    def __init__(self, basepath: Path, codec: Codec = None, chunk_size: int = 2**16, file_extension: str = 'json',
+                 layout: Layout = None):
+        self.basepath = basepath
+        self.codec = Codec('gzip') if codec is None else codec
+        if self.codec.name not in self.content_encodings:
+            raise Exception(f"{self.codec.name} is not an http content encoding")
+        self.content_encoding = self.content_encodings[self.codec.name]
+        self.chunk_size = chunk_size
+        self.file_extension = file_extension
+        self.layout = layout
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.content_encoding})'
+
+    async def __call__(self, session, url, headers, timeout):
+        headers = {} if headers is None else dict(headers)
+        headers['Accept-Encoding'] = self.content_encoding
+        async with session.get(url, headers=headers, timeout=timeout, auto_decompress=False) as response:
+            output = PassthroughOutput(url, headers=response.headers, basepath=self.basepath,
+                                       file_extension=self.file_extension, codec=self.codec, layout=self.layout)
+            encoding = response.headers.get('Content-Encoding', 'identity').lower()
+            if response.status != 200:
+                log.info(f"Status {response.status} {url}")
+            elif encoding == self.content_encoding:
+                await output.write_raw(response.content, chunk_size=self.chunk_size)
+            elif encoding == 'identity':
+                # the server did not compress, so it is compressed here once
+                await output.write_stream(response.content, chunk_size=self.chunk_size)
+            else:
+                log.info(f"Unexpected content encoding {encoding} {url}")
+            return output
+
+
+class JsonFetch:
+    def __init__(self, basepath: Path, output=CsvOutput, key: str = None, lines: bool = False,
+                 embedded: bool = False, batch: bool = False, threshold: int = 2**20, executor=None,
+                 layout: Layout = None):
+        self.basepath = basepath
+        self.layout = layout
+        self.output = output
+        self.key = [] if key is None else key.split('.')
+        self.lines = lines
+        self.embedded = embedded
+        self.batch = batch
+        self.threshold = threshold
+        self.executor = executor
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.output.__name__}, key={".".join(self.key)})'
+
+    def decode(self, body: bytes):
+        if self.lines:
+            rows = (loads(line) for line in body.splitlines() if line.strip())
+            return Batch.from_rows(rows) if self.batch else list(rows)
+        data = loads(body)
+        if self.embedded and isinstance(data, str):
+            # a json document sent as a json string
+            data = loads(data)
+        for key in self.key:
+            data = data[key]
+        if self.batch and isinstance(data, list):
+            return Batch.from_rows(data)
+        return data
+
+    async def read_lines(self, content, chunk_size: int = 2**16):
+        # json lines are decoded as they arrive, only the rows and one chunk are held, never the whole body
+        rows = Batch() if self.batch else []
+        buff = bytearray()
+        async for chunk in content.iter_chunked(chunk_size):
+            buff += chunk
+            end = buff.rfind(b'\n')
+            if end >= 0:
+                for line in bytes(buff[:end]).split(b'\n'):
+                    if line.strip():
+                        rows.append(loads(line))
+                del buff[:end + 1]
+        if buff.strip():
+            rows.append(loads(bytes(buff)))
+        return rows
+
+    async def __call__(self, session, url, headers, timeout):
+        async with session.get(url, headers=headers, timeout=timeout) as response:
+            if response.status != 200:
+                log.info(f"Status {response.status} {url}")
+                return self.output([], url, headers=response.headers, basepath=self.basepath, layout=self.layout)
+            if self.lines:
+                content = await self.read_lines(response.content)
+                return self.output(content, url, headers=response.headers, basepath=self.basepath,
+                                   layout=self.layout)
+            body = await response.read()
+        if len(body) >= self.threshold:
+            content = await asyncio.get_running_loop().run_in_executor(self.executor, self.decode, body)
+        else:
+            content = self.decode(body)
+        return self.output(content, url, headers=response.headers, basepath=self.basepath, layout=self.layout)
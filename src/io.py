@@ -1,12 +1,20 @@
 import urllib
-import io
+import asyncio
 import csv
 import logging
 from pathlib import Path
 import uuid
 from .abc.io import OutputABC
+from .core import Batch, Layout
 from abc import abstractmethod
+import time
+import itertools
+import threading
 import gzip
+import zlib
+import bz2
+import lzma
+import json
 
 
 log = logging.getLogger(__file__)
@@ -20,27 +28,58 @@ log.setLevel(logging.INFO)
 try:
     import pyorc
 except ImportError:
+    pyorc = None
     log.debug("pyrorc is not installed")
 
 
 class Output(OutputABC):
+    # whether dump() serializes the content, a CompressedOutput or a RollingSink is fed through it
+    is_dumpable = True
 
-    def __init__(self, content, url: str, headers: dict = None, basepath: Path = None):
+    def __init__(self, content, url: str, headers: dict = None, basepath: Path = None, layout: Layout = None):
         self.content = content
         self.url = url
         self.id = str(uuid.uuid5(uuid.NAMESPACE_DNS, url))
         self.domain_name = urllib.parse.urlparse(self.url).netloc
         self.headers = headers
         self.basepath = basepath.resolve()
-        self.buffer = None
+        self.layout = layout
+        # encoding options set by write_buff, None until the output is ready to be written
+        self.options = None
+        self.nbytes = None
+        self.part = None
+        self.offset = None
+
+    def __getstate__(self):
+        # response headers are multidict proxies, which can not cross a process boundary
+        state = self.__dict__.copy()
+        if self.headers is not None:
+            state['headers'] = dict(self.headers)
+        return state
 
     def filepath(self) -> Path:
         filename = f'{self.id}.{self.file_extension}'
+        if self.layout is not None:
+            return self.layout.directory(self.basepath, self.id).joinpath(filename)
         self.basepath.mkdir(parents=False, exist_ok=True)
         return self.basepath.joinpath(filename)
 
+    def filename(self) -> str:
+        # relative to basepath, so sharded files keep their prefix directories
+        if self.part is not None:
+            return self.part
+        return self.filepath().relative_to(self.basepath).as_posix()
+
+    def length(self) -> int:
+        return 0 if self.content is None else len(self.content)
+
+    def is_empty(self) -> bool:
+        return self.length() == 0
+
     def get_header(self) -> dict.keys:
-        if isinstance(self.content, list):
+        if isinstance(self.content, Batch):
+            return self.content.columns
+        elif isinstance(self.content, list):
             if len(self.content) > 0:
                 if isinstance(self.content[0], dict):
                     return self.content[0].keys()
@@ -66,6 +105,18 @@ class Output(OutputABC):
         self.write_buff()
         self.write_disk()
 
+    def encode(self, encoder, **options):
+        raise NotImplementedError
+
+    def dump(self, f, chunk_size: int = 2**16) -> int:
+        # serializes straight into the binary file object, the whole payload is never held as one string
+        if self.options is None:
+            return 0
+        encoder = TextEncoder(f, chunk_size=chunk_size)
+        self.encode(encoder, **self.options)
+        encoder.flush()
+        return encoder.nbytes
+
     @abstractmethod
     def clean(self):
         raise NotImplementedError
@@ -77,17 +128,25 @@ class CsvOutput(Output):
     def write_buff(self, header=True, sep='|'):
         if not self.is_valid():
             raise Exception("not csv compatible")
+        self.options = {'header': header, 'sep': sep}
+
+    def encode(self, encoder, header=True, sep='|'):
         names = self.get_header()
-        self.buffer = io.StringIO()
-        dict_writer = csv.DictWriter(self.buffer, fieldnames=names, delimiter=sep)
+        if isinstance(self.content, Batch):
+            csv_writer = csv.writer(encoder, delimiter=sep)
+            if header is True:
+                csv_writer.writerow(names)
+            csv_writer.writerows(self.content.rows())
+            return
+        dict_writer = csv.DictWriter(encoder, fieldnames=names, delimiter=sep)
         if header is True:
             dict_writer.writeheader()
         dict_writer.writerows(self.content)
 
     def write_disk(self):
-        if self.buffer is not None:
-            with self.filepath().open('w', encoding='utf-8', newline='') as f:
-                f.write(self.buffer.getvalue())
+        if self.options is not None:
+            with self.filepath().open('wb') as f:
+                self.nbytes = self.dump(f)
 
     def is_valid(self) -> bool:
         return self.get_header() is not None
@@ -100,55 +159,519 @@ class TextOutput(Output):
     file_extension = 'txt'
 
     def write_buff(self):
-        log.info(len(self.content))
-        if len(self.content) > 0:
-            self.buffer = io.StringIO()
-            self.buffer.write(str(self.content))
+        log.debug(self.length())
+        if not self.is_empty():
+            self.options = {}
+
+    def encode(self, encoder):
+        # same text as str(self.content), written an item at a time
+        if isinstance(self.content, Batch):
+            self.write_batch(encoder, self.content)
+        elif isinstance(self.content, list):
+            encoder.write('[')
+            for i, item in enumerate(self.content):
+                if i > 0:
+                    encoder.write(', ')
+                encoder.write(repr(item))
+            encoder.write(']')
+        elif isinstance(self.content, dict):
+            encoder.write('{')
+            for i, (key, value) in enumerate(self.content.items()):
+                if i > 0:
+                    encoder.write(', ')
+                encoder.write(f'{key!r}: {value!r}')
+            encoder.write('}')
+        else:
+            encoder.write(str(self.content))
+
+    @staticmethod
+    def write_batch(encoder, batch: Batch):
+        # same text as str() of the equivalent list of dicts, without building the dicts
+        keys = [f'{name!r}: ' for name in batch.columns]
+        encoder.write('[')
+        for i, row in enumerate(batch.rows()):
+            if i > 0:
+                encoder.write(', ')
+            encoder.write('{' + ', '.join([key + repr(value) for key, value in zip(keys, row)]) + '}')
+        encoder.write(']')
+
+    def write_disk(self):
+        if self.options is not None:
+            with self.filepath().open('wb') as f:
+                self.nbytes = self.dump(f)
+
+    def clean(self):
+        self.filepath().unlink(True)
+
+
+class TextEncoder:
+    # file like target for csv writers and friends, text is encoded to the binary file once a chunk fills up
+    def __init__(self, f, chunk_size: int = 2**16, encoding: str = 'utf-8'):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.encoding = encoding
+        # reused for every chunk, so at most one encoded chunk is alive at a time
+        self.buffer = bytearray()
+        self.nbytes = 0
+
+    def write(self, text: str) -> int:
+        self.buffer += text.encode(self.encoding)
+        if len(self.buffer) >= self.chunk_size:
+            self.flush()
+        return len(text)
+
+    def flush(self):
+        if len(self.buffer) > 0:
+            self.f.write(self.buffer)
+            self.nbytes += len(self.buffer)
+            self.buffer.clear()
+
+
+class ZlibFile:
+    def __init__(self, fileobj, level: int = -1):
+        self.fileobj = fileobj
+        self.compressor = zlib.compressobj(level)
+
+    def write(self, data) -> int:
+        self.fileobj.write(self.compressor.compress(data))
+        return len(data)
+
+    def close(self):
+        if self.compressor is not None:
+            self.fileobj.write(self.compressor.flush())
+            self.compressor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class InflateCounter:
+    def __init__(self, fileobj, chunk_size: int = 2**16):
+        # writes zlib data through unchanged and counts its inflated size, chunk_size bounds the inflated buffer
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        self.decompressor = None
+        self.nbytes = 0
+
+    def write(self, data) -> int:
+        self.fileobj.write(data)
+        if self.decompressor is None and len(data) > 0:
+            # http deflate is meant to be zlib wrapped, some servers send a raw deflate stream
+            is_zlib = len(data) > 1 and data[0] & 0x0f == 8 and (data[0] << 8 | data[1]) % 31 == 0
+            self.decompressor = zlib.decompressobj(zlib.MAX_WBITS if is_zlib else -zlib.MAX_WBITS)
+        tail = data
+        while tail:
+            self.nbytes += len(self.decompressor.decompress(tail, self.chunk_size))
+            tail = self.decompressor.unconsumed_tail
+        return len(data)
+
+    def close(self):
+        if self.decompressor is not None:
+            self.nbytes += len(self.decompressor.flush())
+
+
+class Codec:
+    file_extensions = {'gzip': 'gz', 'zlib': 'zz', 'bz2': 'bz2', 'lzma': 'xz'}
+
+    def __init__(self, name: str = 'gzip', level: int = None):
+        if name not in self.file_extensions:
+            raise Exception(f"unknown codec {name}")
+        self.name = name
+        self.level = level
+        self.file_extension = self.file_extensions[name]
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.name}, level={self.level})'
+
+    def __call__(self, output: Output) -> 'CompressedOutput':
+        return CompressedOutput(output, codec=self)
+
+    def open(self, f):
+        if self.name == 'gzip':
+            return gzip.GzipFile(fileobj=f, mode='wb', compresslevel=9 if self.level is None else self.level)
+        elif self.name == 'bz2':
+            return bz2.BZ2File(f, mode='wb', compresslevel=9 if self.level is None else self.level)
+        elif self.name == 'lzma':
+            return lzma.LZMAFile(f, mode='wb', preset=self.level)
+        else:
+            return ZlibFile(f, level=-1 if self.level is None else self.level)
+
+
+class RawOutput(Output):
+    file_extension = 'raw'
+    # the body goes to disk while it streams, pass a codec to compress it there
+    is_dumpable = False
+
+    def __init__(self, url: str, headers: dict = None, basepath: Path = None, file_extension: str = None,
+                 codec: Codec = None, layout: Layout = None):
+        super(RawOutput, self).__init__(None, url, headers=headers, basepath=basepath, layout=layout)
+        if file_extension is not None:
+            self.file_extension = file_extension
+        self.codec = codec
+        if codec is not None:
+            self.file_extension = f'{self.file_extension}.{codec.file_extension}'
+        self.bytes_received = 0
+
+    def length(self) -> int:
+        # a raw body has no records, its length is the number of bytes received
+        return self.bytes_received
+
+    async def write_stream(self, content, chunk_size: int = 2**16):
+        wrap = None if self.codec is None else self.codec.open
+        await self.write_chunks(content.iter_chunked(chunk_size), wrap=wrap)
+
+    async def write_chunks(self, chunks, wrap=None):
+        # file writes and compression run in the default executor, one chunk behind the socket reads,
+        # wrap turns the file into the object the chunks are written to and is closed before the file
+        loop = asyncio.get_running_loop()
+        f = await loop.run_in_executor(None, lambda: self.filepath().open('wb'))
+        dst = f if wrap is None else wrap(f)
+        pending = None
+        try:
+            async for chunk in chunks:
+                if pending is not None:
+                    await pending
+                pending = loop.run_in_executor(None, dst.write, chunk)
+                self.bytes_received += len(chunk)
+            if pending is not None:
+                await pending
+                pending = None
+            if dst is not f:
+                await loop.run_in_executor(None, dst.close)
+            self.nbytes = f.tell()
+        finally:
+            if pending is not None:
+                # a write still running in the executor must not see a closed file
+                await asyncio.wait([pending])
+            f.close()
+        return dst
+
+    def write_buff(self):
+        pass
 
     def write_disk(self):
-        if self.buffer is not None:
-            with self.filepath().open('w', encoding='utf-8') as f:
-                f.write(self.buffer.getvalue())
+        pass
 
     def clean(self):
         self.filepath().unlink(True)
 
 
+def orc_columns(output: Output, types: dict = None, sample: int = 100) -> dict:
+    # the orc type of every column is widened over the sampled values, unless it is given in types
+    types = {} if types is None else types
+    names = list(output.get_header() or [])
+    if len(names) == 0:
+        return {}
+    if isinstance(output.content, Batch):
+        rows = itertools.islice(output.content.rows(), sample)
+    else:
+        rows = (tuple(r.get(name) for name in names) for r in itertools.islice(output.content, sample))
+    inferred = {}
+    for row in rows:
+        for name, value in zip(names, row):
+            if value is not None:
+                inferred[name] = orc_widen(inferred.get(name), type(value))
+    return {name: types.get(name, inferred.get(name, 'string')) for name in names}
+
+
+def orc_schema(output: Output, types: dict = None, sample: int = 100) -> str:
+    return orc_struct(orc_columns(output, types=types, sample=sample))
+
+
+def orc_struct(columns: dict) -> str:
+    return f"struct<{','.join(f'{name}:{orc_type}' for name, orc_type in columns.items())}>"
+
+
+def orc_widen(orc_type: str, value_type: type) -> str:
+    return orc_merge(orc_type, orc_types.get(value_type, 'string'))
+
+
+def orc_merge(orc_type: str, other: str) -> str:
+    # int and float widen to double, any other mix, dicts and lists are written as strings
+    if orc_type is None or orc_type == other:
+        return other
+    if other is None:
+        return orc_type
+    if {orc_type, other} == {'bigint', 'double'}:
+        return 'double'
+    return 'string'
+
+
+def orc_string(value):
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, (dict, list)):
+        # nested values are kept as json text
+        return json.dumps(value, default=str)
+    return str(value)
+
+
+def orc_double(value):
+    return value if value is None else float(value)
+
+
+def orc_rows(output: Output, names: list, columns: dict = None):
+    if isinstance(output.content, Batch) and output.content.columns == names:
+        rows = output.content.rows()
+    elif isinstance(output.content, Batch):
+        rows = (tuple(row.get(name) for name in names) for row in output.content.to_list())
+    else:
+        # rows follow the schema order, not the order of the keys in every dict
+        rows = (tuple(r.get(name) for name in names) for r in output.content)
+    if columns is None:
+        return rows
+    converters = [orc_converters.get(columns[name]) for name in names]
+    if all(converter is None for converter in converters):
+        return rows
+    return (tuple(value if converter is None else converter(value) for converter, value in zip(converters, row))
+            for row in rows)
+
+
+orc_types = {bool: 'boolean', int: 'bigint', float: 'double', str: 'string'}
+orc_converters = {'string': orc_string, 'double': orc_double}
+
+
+class PassthroughOutput(RawOutput):
+    def __init__(self, url: str, headers: dict = None, basepath: Path = None, file_extension: str = None,
+                 codec: Codec = None, layout: Layout = None):
+        super(PassthroughOutput, self).__init__(url, headers=headers, basepath=basepath,
+                                                file_extension=file_extension, codec=codec, layout=layout)
+        self.raw_nbytes = None
+
+    def length(self) -> int:
+        # uncompressed size, the compressed size goes to nbytes
+        return 0 if self.raw_nbytes is None else self.raw_nbytes
+
+    def is_empty(self) -> bool:
+        return self.bytes_received == 0
+
+    async def write_raw(self, content, chunk_size: int = 2**16):
+        # the body is already in the stored encoding, it goes to disk as it came over the wire
+        tail = b''
+
+        async def chunks():
+            nonlocal tail
+            async for chunk in content.iter_chunked(chunk_size):
+                tail = (tail + chunk)[-4:]
+                yield chunk
+
+        if self.codec.name == 'gzip':
+            await self.write_chunks(chunks())
+            if len(tail) == 4:
+                # ISIZE trailer, the uncompressed size modulo 2**32 of the last gzip member
+                self.raw_nbytes = int.from_bytes(tail, 'little')
+        else:
+            # a zlib stream has no size trailer, it is inflated on the side only to be counted
+            dst = await self.write_chunks(chunks(), wrap=InflateCounter)
+            self.raw_nbytes = dst.nbytes
+
+    async def write_stream(self, content, chunk_size: int = 2**16):
+        await super(PassthroughOutput, self).write_stream(content, chunk_size=chunk_size)
+        self.raw_nbytes = self.bytes_received
+
+    def ratio(self) -> float:
+        if not self.nbytes or self.raw_nbytes is None:
+            return 0.
+        return self.raw_nbytes / self.nbytes
+
+
 class OrcOuput(Output):
     file_extension = 'orc'
+    srt_type = None
+    # orc compresses its own stripes, use OrcSink(compression=...)
+    is_dumpable = False
+
+    def write_buff(self):
+        pass
+
+    def write_disk(self):
+        # an empty page has no columns to build a schema from
+        if not self.is_empty():
+            self.write(self.srt_type)
 
     def write(self, srt_type: dict = None):
-        headers = self.get_header()
-        cols = []
-        for key in headers:
-            ctype = srt_type[key]
-            cols.append(f'{key}:{ctype}')
-        str_cols = ",".join(cols)
-        struct_col = f"struct<{str_cols}>"
+        columns = orc_columns(self, types=srt_type)
+        struct_col = orc_struct(columns)
+        names = list(columns)
         with self.filepath().open("wb") as f:
             with pyorc.Writer(f, struct_col) as writer:
-                for r in self.content:
-                    writer.write(tuple(r.values()))
+                writer.writerows(orc_rows(self, names, columns))
+            self.nbytes = f.tell()
 
     def clean(self):
-        self.filepath().unlink()
-
+        self.filepath().unlink(True)
 
-class GzipOutput(Output):
-    file_extension = 'gz'
 
-    def __init__(self, output: Output):
-        super(GzipOutput, self).__init__(output.content, output.url, basepath=output.basepath)
+class CompressedOutput(Output):
+    def __init__(self, output: Output, codec: Codec = None):
+        if not output.is_dumpable:
+            raise Exception(f"{output.__class__.__name__} can not be compressed, it would write an empty stream")
+        super(CompressedOutput, self).__init__(output.content, output.url, basepath=output.basepath,
+                                               layout=output.layout)
         self.output = output
+        self.codec = Codec() if codec is None else codec
+        self.file_extension = self.codec.file_extension
+        self.raw_nbytes = None
+        self.elapsed = None
 
     def write_buff(self):
-        self.buffer = io.BytesIO()
-        with gzip.GzipFile(fileobj=self.buffer, mode='wb') as f:
-            f.write(self.output.buffer.getvalue().encode())
+        pass
 
     def write_disk(self):
         with self.filepath().open(mode='wb') as f:
-            f.write(self.buffer.getvalue())
+            self.nbytes = self.dump(f)
+
+    def dump(self, f, chunk_size: int = 2**16) -> int:
+        # every call writes one complete stream, so appended members stay independently readable
+        start = time.perf_counter()
+        offset = f.tell()
+        with self.codec.open(f) as dst:
+            self.raw_nbytes = self.output.dump(dst, chunk_size=chunk_size)
+        nbytes = f.tell() - offset
+        self.elapsed = time.perf_counter() - start
+        log.debug(f'{self.codec.name} {self.raw_nbytes} -> {nbytes} bytes, '
+                  f'ratio {self.raw_nbytes / max(nbytes, 1):.2f}, {self.elapsed:.4f}s')
+        return nbytes
+
+    def ratio(self) -> float:
+        if not self.nbytes:
+            return 0.
+        return self.raw_nbytes / self.nbytes
 
     def clean(self):
-        self.filepath().unlink()
+        self.filepath().unlink(True)
+
+
+class GzipOutput(CompressedOutput):
+    def __init__(self, output: Output, level: int = 9):
+        super(GzipOutput, self).__init__(output, codec=Codec('gzip', level))
+
+
+class RollingSink:
+    def __init__(self, basepath: Path, name: str = 'part', max_bytes: int = 2**27, max_records: int = None,
+                 max_seconds: float = None):
+        self.basepath = basepath.resolve()
+        self.name = name
+        self.max_bytes = max_bytes
+        self.max_records = max_records
+        self.max_seconds = max_seconds
+        self.file = None
+        self.filename = None
+        self.index = None
+        self.nbytes = 0
+        self.records = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.basepath}, name={self.name})'
+
+    def is_full(self) -> bool:
+        if self.max_bytes is not None and self.nbytes >= self.max_bytes:
+            return True
+        if self.max_records is not None and self.records >= self.max_records:
+            return True
+        if self.max_seconds is not None and time.monotonic() - self.opened_at >= self.max_seconds:
+            return True
+        return False
+
+    def next_index(self) -> int:
+        # continue numbering after the parts left by previous runs instead of overwriting them
+        index = -1
+        for path in self.basepath.glob(f'{self.name}-*'):
+            try:
+                index = max(index, int(path.name[len(self.name) + 1:].split('.')[0]))
+            except ValueError:
+                continue
+        return index + 1
+
+    def rotate(self, file_extension: str):
+        self.close()
+        self.basepath.mkdir(parents=False, exist_ok=True)
+        self.index = self.next_index() if self.index is None else self.index + 1
+        self.filename = f'{self.name}-{self.index:06d}.{file_extension}'
+        self.file = self.basepath.joinpath(self.filename).open('wb')
+        self.nbytes = 0
+        self.records = 0
+        self.opened_at = time.monotonic()
+
+    def write(self, output: Output):
+        if not output.is_dumpable:
+            # the part would get 0 bytes while the metadata points at it
+            raise Exception(f"{output.__class__.__name__} can not be written to a {self.__class__.__name__}")
+        if output.is_empty():
+            return
+        with self.lock:
+            if self.file is None or self.is_full():
+                self.rotate(output.file_extension)
+            offset = self.nbytes
+            nbytes = output.dump(self.file)
+            self.nbytes += nbytes
+            self.records += output.length()
+            output.part = self.filename
+            output.offset = offset
+            output.nbytes = nbytes
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class OrcSink(RollingSink):
+    def __init__(self, basepath: Path, name: str = 'part', max_bytes: int = 2**28, max_records: int = None,
+                 max_seconds: float = None, types: dict = None, stripe_size: int = 2**26, batch_size: int = 1024,
+                 compression: str = 'zlib'):
+        super(OrcSink, self).__init__(basepath, name=name, max_bytes=max_bytes, max_records=max_records,
+                                      max_seconds=max_seconds)
+        self.types = types
+        self.stripe_size = stripe_size
+        self.batch_size = batch_size
+        self.compression = compression
+        self.schema = None
+        self.columns = None
+        self.names = None
+        self.writer = None
+
+    def rotate(self, file_extension: str):
+        super(OrcSink, self).rotate(file_extension)
+        self.writer = pyorc.Writer(self.file, self.schema, batch_size=self.batch_size,
+                                   stripe_size=self.stripe_size,
+                                   compression=getattr(pyorc.CompressionKind, self.compression.upper()))
+
+    def write(self, output: Output):
+        if isinstance(output, RawOutput):
+            raise Exception(f"{output.__class__.__name__} has no records to write to a {self.__class__.__name__}")
+        if output.is_empty():
+            return
+        with self.lock:
+            # inferred from the first output and widened when a later one does not fit,
+            # a part has a single schema so a wider one starts the next part
+            columns = orc_columns(output, types=self.types)
+            if self.columns is not None:
+                columns = {name: orc_merge(self.columns.get(name), columns.get(name))
+                           for name in list(self.columns) + [name for name in columns if name not in self.columns]}
+            is_drifted = columns != self.columns
+            if is_drifted:
+                self.columns = columns
+                self.schema = orc_struct(self.columns)
+                self.names = list(self.columns)
+            if self.writer is None or self.is_full() or is_drifted:
+                self.rotate('orc')
+            offset = self.records
+            self.writer.writerows(orc_rows(output, self.names, self.columns))
+            self.records += output.length()
+            # orc buffers a stripe in memory, the file grows when a stripe is flushed
+            self.nbytes = self.file.tell()
+            output.part = self.filename
+            output.offset = offset
+            output.nbytes = None
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        super(OrcSink, self).close()
@@ -0,0 +1,207 @@
+import logging
+import asyncio
+import aiohttp
+import bisect
+import os
+import random
+import time
+import urllib
+from pathlib import Path
+
+
+log = logging.getLogger(__file__)
+log_handler = logging.StreamHandler()
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+log_handler.setFormatter(formatter)
+log.addHandler(log_handler)
+log.setLevel(logging.INFO)
+
+
+class Histogram:
+    # 1ms .. ~65s, doubling, the last bucket is +Inf
+    bounds = tuple(.001 * 2**i for i in range(17))
+
+    def __init__(self, bounds: tuple = None):
+        if bounds is not None:
+            self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.
+        self.count = 0
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(count={self.count}, p50={self.quantile(.5)}, p99={self.quantile(.99)})'
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        # upper bound of the bucket holding the q-th observation
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        total = 0
+        for bound, count in zip(self.bounds, self.counts):
+            total += count
+            if total >= rank:
+                return bound
+        return float('inf')
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+            total += count
+            yield bound, total
+
+
+class Metrics:
+    def __init__(self, filepath: Path = None, interval: float = 10., hook=None, sample_rate: float = 0.,
+                 prefix: str = 'traepi'):
+        self.filepath = filepath
+        self.interval = interval
+        self.hook = hook
+        self.sample_rate = sample_rate
+        self.prefix = prefix
+        # (phase, domain) -> Histogram
+        self.histograms = {}
+        # (name, domain) -> int
+        self.counters = {}
+        self.gauges = {}
+        self.task = None
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.filepath}, histograms={len(self.histograms)})'
+
+    @staticmethod
+    def domain(url) -> str:
+        return urllib.parse.urlparse(str(url)).netloc
+
+    def observe(self, phase: str, domain: str, value: float):
+        key = (phase, domain)
+        if key not in self.histograms:
+            self.histograms[key] = Histogram()
+        self.histograms[key].observe(value)
+
+    def incr(self, name: str, domain: str, value: int = 1):
+        key = (name, domain)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name: str, value: float):
+        self.gauges[name] = value
+
+    def sample(self, message: str):
+        if self.sample_rate > 0 and random.random() < self.sample_rate:
+            log.info(message)
+
+    def trace_config(self) -> aiohttp.TraceConfig:
+        # the context is a fresh namespace per request shared by all the signals of that request
+        async def on_request_start(session, context, params):
+            context.start = time.monotonic()
+            # the dns signals only carry the host, every series is labelled by the netloc of the url
+            context.domain = self.domain(params.url)
+
+        async def on_dns_resolvehost_start(session, context, params):
+            context.dns_start = time.monotonic()
+
+        async def on_dns_resolvehost_end(session, context, params):
+            self.observe('dns', context.domain, time.monotonic() - context.dns_start)
+
+        async def on_connection_create_start(session, context, params):
+            context.connect_start = time.monotonic()
+
+        async def on_connection_create_end(session, context, params):
+            context.connect = time.monotonic() - context.connect_start
+
+        async def on_request_end(session, context, params):
+            # fires once the response headers arrived
+            ttfb = time.monotonic() - context.start
+            domain = self.domain(params.url)
+            self.observe('ttfb', domain, ttfb)
+            if hasattr(context, 'connect'):
+                self.observe('connect', domain, context.connect)
+            self.incr('responses', domain)
+            self.sample(f"{params.method} {params.url} {params.response.status} ttfb {ttfb:.4f}s")
+
+        async def on_response_chunk_received(session, context, params):
+            self.incr('bytes_received', self.domain(params.url), len(params.chunk))
+
+        async def on_request_exception(session, context, params):
+            self.incr('errors', self.domain(params.url))
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_dns_resolvehost_start.append(on_dns_resolvehost_start)
+        trace_config.on_dns_resolvehost_end.append(on_dns_resolvehost_end)
+        trace_config.on_connection_create_start.append(on_connection_create_start)
+        trace_config.on_connection_create_end.append(on_connection_create_end)
+        trace_config.on_request_end.append(on_request_end)
+        trace_config.on_response_chunk_received.append(on_response_chunk_received)
+        trace_config.on_request_exception.append(on_request_exception)
+        return trace_config
+
+    def written(self, output, elapsed: float):
+        domain = self.domain(output.url)
+        self.observe('write', domain, elapsed)
+        self.incr('bytes_written', domain, getattr(output, 'nbytes', None) or 0)
+
+    def snapshot(self) -> dict:
+        return {
+            'histograms': {f'{phase}:{domain}': {'count': h.count, 'sum': h.sum, 'p50': h.quantile(.5),
+                                                 'p99': h.quantile(.99)}
+                           for (phase, domain), h in self.histograms.items()},
+            'counters': {f'{name}:{domain}': value for (name, domain), value in self.counters.items()},
+            'gauges': dict(self.gauges)
+        }
+
+    def prometheus(self) -> str:
+        lines = []
+        name = f'{self.prefix}_seconds'
+        lines.append(f'# TYPE {name} histogram')
+        for (phase, domain), h in sorted(self.histograms.items()):
+            labels = f'phase="{phase}",domain="{domain}"'
+            for bound, total in h.cumulative():
+                le = '+Inf' if bound == float('inf') else f'{bound:g}'
+                lines.append(f'{name}_bucket{{{labels},le="{le}"}} {total}')
+            lines.append(f'{name}_sum{{{labels}}} {h.sum}')
+            lines.append(f'{name}_count{{{labels}}} {h.count}')
+        for counter in sorted({name for name, _ in self.counters}):
+            lines.append(f'# TYPE {self.prefix}_{counter}_total counter')
+            for (name, domain), value in sorted(self.counters.items()):
+                if name == counter:
+                    lines.append(f'{self.prefix}_{name}_total{{domain="{domain}"}} {value}')
+        for name, value in sorted(self.gauges.items()):
+            lines.append(f'# TYPE {self.prefix}_{name} gauge')
+            lines.append(f'{self.prefix}_{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self):
+        # written aside and renamed so a scraper never reads a half written file
+        tmp_filepath = self.filepath.with_name(f'{self.filepath.name}.tmp')
+        tmp_filepath.write_text(self.prometheus(), encoding='utf-8')
+        os.replace(tmp_filepath, self.filepath)
+
+    def flush(self):
+        if self.filepath is not None:
+            self.write()
+        if self.hook is not None:
+            self.hook(self)
+
+    async def periodic(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                log.exception("Metrics snapshot error")
+
+    def start(self):
+        if self.task is None and (self.filepath is not None or self.hook is not None):
+            self.task = asyncio.create_task(self.periodic())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        self.flush()
@@ -0,0 +1,157 @@
+import logging
+import os
+import time
+import queue
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from .abc.core import MetadataABC, StreamABC
+from .core import Request, BuffStream, CSVMetadata, DigestSet, StreamPage, AsyncStream
+
+
+log = logging.getLogger(__file__)
+log_handler = logging.StreamHandler()
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+log_handler.setFormatter(formatter)
+log.addHandler(log_handler)
+log.setLevel(logging.INFO)
+
+
+class ShardStream(StreamABC):
+    def __init__(self, stream: StreamABC, index: int, count: int):
+        self.stream = stream
+        self.index = index
+        self.count = count
+        self.response_wait_key = stream.response_wait_key
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.index}/{self.count})'
+
+    def set_next(self, value):
+        return self.stream.set_next(value)
+
+    def restore(self, url):
+        self.stream.restore(url)
+
+    def __next__(self):
+        # the url digest picks the shard, so every worker sees the same split on every run
+        while True:
+            url = next(self.stream)
+            if DigestSet.digest(url) % self.count == self.index:
+                return url
+
+
+class ProgressMetadata(MetadataABC):
+    def __init__(self, metadata: MetadataABC, progress, index: int, interval: float = 1., merged: MetadataABC = None):
+        super(ProgressMetadata, self).__init__(metadata.basepath)
+        self.metadata = metadata
+        # the journal the shards are merged into after every run, resume reads from it
+        self.merged = merged
+        self.progress = progress
+        self.index = index
+        self.interval = interval
+        self.outputs = 0
+        self.errors = 0
+        self.last_report = time.monotonic()
+
+    def report(self, force: bool = False):
+        if force or time.monotonic() - self.last_report >= self.interval:
+            self.progress.put((self.index, self.outputs, self.errors))
+            self.last_report = time.monotonic()
+
+    def write(self, output):
+        self.metadata.write(output)
+        self.outputs += 1
+        self.report()
+
+    def error(self, name, url):
+        self.metadata.error(name, url)
+        self.errors += 1
+        self.report()
+
+    def completed(self):
+        if self.merged is not None:
+            yield from self.merged.completed()
+        yield from self.metadata.completed()
+
+    def clean(self):
+        self.metadata.clean()
+
+    def close(self):
+        self.metadata.close()
+        self.report(force=True)
+
+
+def run_shard(index: int, streams: list, callback, basepath: Path, metadata_class, progress, mode: str,
+              buff_size: int, request_kwargs: dict, output_kwargs: dict) -> dict:
+    metadata = metadata_class(basepath)
+    metadata.filename = f'{metadata.filename}-{index}'
+    metadata = ProgressMetadata(metadata, progress, index, merged=metadata_class(basepath))
+    for stream in streams:
+        request = Request(BuffStream(stream, buff_size=buff_size), metadata, **request_kwargs)
+        request.run(request.output(getattr(request, mode)(callback=callback), **output_kwargs))
+    return {'index': index, 'outputs': metadata.outputs, 'errors': metadata.errors}
+
+
+class ShardedRunner:
+    def __init__(self, workers: int = None, buff_size: int = 5, mode: str = 'window', interval: float = 1.):
+        self.workers = os.cpu_count() if workers is None else workers
+        self.buff_size = buff_size
+        self.mode = mode
+        self.interval = interval
+        self.progress = {}
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(workers={self.workers}, mode={self.mode})'
+
+    def shards(self, streams) -> list:
+        # a single stream is split by url, a list of streams (e.g. StreamPage sources) is dealt out whole
+        if isinstance(streams, (list, tuple)):
+            return [list(streams[i::self.workers]) for i in range(self.workers)]
+        if isinstance(streams, StreamPage) or streams.response_wait_key is not None:
+            raise Exception("a paged stream can not be split by url, pass a list of streams")
+        if isinstance(streams, AsyncStream):
+            raise Exception("an async stream can not be sent to worker processes")
+        return [[ShardStream(streams, i, self.workers)] for i in range(self.workers)]
+
+    def totals(self) -> dict:
+        return {'outputs': sum(outputs for outputs, _ in self.progress.values()),
+                'errors': sum(errors for _, errors in self.progress.values())}
+
+    def run(self, streams, callback, basepath: Path, metadata_class=CSVMetadata, request_kwargs: dict = None,
+            **output_kwargs) -> dict:
+        request_kwargs = {} if request_kwargs is None else request_kwargs
+        shards = [shard for shard in self.shards(streams) if len(shard) > 0]
+        self.progress = {}
+        with multiprocessing.Manager() as manager:
+            progress = manager.Queue()
+            with ProcessPoolExecutor(max_workers=len(shards)) as executor:
+                futures = [executor.submit(run_shard, index, shard, callback, basepath, metadata_class, progress,
+                                           self.mode, self.buff_size, request_kwargs, output_kwargs)
+                           for index, shard in enumerate(shards)]
+                while not all(future.done() for future in futures):
+                    self.collect(progress, timeout=self.interval)
+                    log.info(f"Progress {self.totals()}")
+                results = [future.result() for future in futures]
+            self.collect(progress)
+        for result in results:
+            self.progress[result['index']] = (result['outputs'], result['errors'])
+        metadata = metadata_class(basepath)
+        shard_metadata = []
+        for index in range(len(shards)):
+            shard = metadata_class(basepath)
+            shard.filename = f'{shard.filename}-{index}'
+            if shard.filepath().exists():
+                shard_metadata.append(shard)
+        metadata.merge(shard_metadata)
+        metadata.close()
+        return self.totals()
+
+    def collect(self, progress, timeout: float = None):
+        while True:
+            try:
+                index, outputs, errors = progress.get(timeout=timeout) if timeout else progress.get_nowait()
+            except queue.Empty:
+                return
+            self.progress[index] = (outputs, errors)
+            timeout = None
@@ -0,0 +1,212 @@
+import argparse
+import itertools
+import json
+import os
+import platform
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from src.core import Request, BuffStream, BaseStream, StreamPage, StreamPageWait, CSVMetadata, SessionPool
+from src.io import CsvOutput, TextOutput, OrcOuput, OrcSink, Codec, pyorc
+from src.metrics import Metrics
+
+
+# python test/benchmark.py --concurrency 4 16 --output before.json
+# python test/benchmark.py --concurrency 4 16 --compare before.json
+
+outputs = {'csv': CsvOutput, 'text': TextOutput, 'gzip': CsvOutput, 'orc': OrcOuput}
+modes = {'base': 'window', 'page': 'prefetch', 'cursor': 'pipeline'}
+
+
+class BenchFetch:
+    def __init__(self, output, basepath: Path):
+        self.output = output
+        self.basepath = basepath
+        self.latencies = []
+
+    async def __call__(self, session, url, headers, timeout):
+        start = time.perf_counter()
+        async with session.get(url, headers=headers, timeout=timeout) as response:
+            r = json.loads(await response.json())
+            output = self.output(r, url, headers=response.headers, basepath=self.basepath)
+        self.latencies.append(time.perf_counter() - start)
+        return output
+
+
+def quantile(values: list, q: float) -> float:
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    return values[round(q * (len(values) - 1))]
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on linux and in bytes on macos
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / 2**20 if sys.platform == 'darwin' else maxrss / 2**10
+
+
+def cpu_seconds() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def stream(case: dict, port: int):
+    params = {'rows': case['rows'], 'latency': case['latency'], 'dist': case['dist']}
+    resource_url = f"http://localhost:{port}/bench"
+    if case['stream'] == 'base':
+        return BaseStream([StreamPage.build_url(resource_url, dict(params, id=i)) for i in range(case['pages'])])
+    elif case['stream'] == 'page':
+        return StreamPage(resource=resource_url, key='pageIndex', pages=case['pages'], **params)
+    elif case['stream'] == 'cursor':
+        return StreamPageWait(resource=resource_url, key='pageIndex', response_wait_key='next',
+                              pages=case['pages'], **params)
+    raise Exception(f"unknown stream {case['stream']}")
+
+
+def run_case(case: dict, port: int, basepath: Path) -> dict:
+    result = dict(case)
+    if case['format'] == 'orc' and pyorc is None:
+        result['skipped'] = "pyorc is not installed"
+        return result
+    basepath = basepath.joinpath(f"{case['stream']}-{case['format']}-{case['concurrency']}")
+    basepath.mkdir(parents=True, exist_ok=True)
+    concurrency = case['concurrency']
+    metrics = Metrics()
+    metadata = CSVMetadata(basepath)
+    buff = BuffStream(stream=stream(case, port), buff_size=concurrency)
+    request = Request(buff=buff, metadata=metadata, pool=SessionPool(limit=concurrency), metrics=metrics)
+    fetch = BenchFetch(outputs[case['format']], basepath)
+    mode = modes[case['stream']]
+    if mode == 'window':
+        coro = request.window(callback=fetch, size=concurrency)
+    elif mode == 'prefetch':
+        coro = request.prefetch(callback=fetch, size=min(2, concurrency), maximum=concurrency)
+    else:
+        coro = request.pipeline(callback=fetch, size=concurrency)
+    kwargs = {}
+    if case['format'] == 'gzip':
+        kwargs['compression'] = Codec('gzip', 6)
+    elif case['format'] == 'orc':
+        kwargs['sink'] = OrcSink(basepath)
+    cpu = cpu_seconds()
+    start = time.perf_counter()
+    request.run(request.output(coro, clean=case['format'] != 'orc', **kwargs))
+    elapsed = time.perf_counter() - start
+    received = sum(value for (name, _), value in metrics.counters.items() if name == 'bytes_received')
+    written = sum(value for (name, _), value in metrics.counters.items() if name == 'bytes_written')
+    shutil.rmtree(basepath)
+    result.update({
+        'requests': len(fetch.latencies),
+        'seconds': elapsed,
+        'pages_s': len(fetch.latencies) / elapsed,
+        'mb_s': received / 2**20 / elapsed,
+        'written_mb': written / 2**20,
+        'p50': quantile(fetch.latencies, .5),
+        'p99': quantile(fetch.latencies, .99),
+        'peak_rss_mb': peak_rss_mb(),
+        'cpu_s': cpu_seconds() - cpu
+    })
+    return result
+
+
+def key(result: dict) -> tuple:
+    return result['stream'], result['format'], result['concurrency']
+
+
+def compare(results: list, baseline: dict, tolerance: float) -> bool:
+    before = {key(result): result for result in baseline['results'] if 'skipped' not in result}
+    ok = True
+    for result in results:
+        previous = before.get(key(result))
+        if previous is None or 'skipped' in result:
+            continue
+        ratio = result['pages_s'] / previous['pages_s']
+        regression = ratio < 1 - tolerance
+        ok = ok and not regression
+        print(f"{'/'.join(map(str, key(result)))}: {previous['pages_s']:.1f} -> {result['pages_s']:.1f} pages/s "
+              f"({ratio:.2f}x){' REGRESSION' if regression else ''}", file=sys.stderr)
+    return ok
+
+
+def wait_port(port: int, timeout: float = 10.):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(('localhost', port), timeout=1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise Exception(f"web server did not start on port {port}")
+            time.sleep(.1)
+
+
+def commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=Path(__file__).resolve().parent, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--basepath', type=Path, default=Path('tmp').joinpath('benchmark'))
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[4, 16])
+    parser.add_argument('--streams', nargs='+', default=list(modes), choices=list(modes))
+    parser.add_argument('--formats', nargs='+', default=list(outputs), choices=list(outputs))
+    parser.add_argument('--pages', type=int, default=200)
+    parser.add_argument('--rows', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=.02)
+    parser.add_argument('--dist', default='fixed', choices=['fixed', 'uniform', 'bimodal', 'lognormal'])
+    parser.add_argument('--output', type=Path)
+    parser.add_argument('--compare', type=Path)
+    parser.add_argument('--tolerance', type=float, default=.1)
+    parser.add_argument('--case', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case is not None:
+        # every case runs in its own process so peak rss and cpu time are not shared between cases
+        print(json.dumps(run_case(json.loads(args.case), args.port, args.basepath)))
+        return
+
+    server = subprocess.Popen([sys.executable, str(Path(__file__).resolve().parent.joinpath('web_server.py')),
+                               str(args.port)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    results = []
+    try:
+        wait_port(args.port)
+        for concurrency, stream_name, format_name in itertools.product(args.concurrency, args.streams,
+                                                                       args.formats):
+            case = {'stream': stream_name, 'format': format_name, 'concurrency': concurrency,
+                    'pages': args.pages, 'rows': args.rows, 'latency': args.latency, 'dist': args.dist}
+            process = subprocess.run([sys.executable, __file__, '--case', json.dumps(case), '--port', str(args.port),
+                                      '--basepath', str(args.basepath)], capture_output=True, text=True, check=True)
+            result = json.loads(process.stdout.splitlines()[-1])
+            print(json.dumps(result), file=sys.stderr)
+            results.append(result)
+    finally:
+        server.terminate()
+        server.wait()
+
+    report = {'commit': commit(), 'python': platform.python_version(), 'platform': platform.platform(),
+              'cpus': os.cpu_count(), 'results': results}
+    if args.output is not None:
+        args.output.write_text(json.dumps(report, indent=2), encoding='utf-8')
+    else:
+        print(json.dumps(report, indent=2))
+    if args.compare is not None:
+        baseline = json.loads(args.compare.read_text(encoding='utf-8'))
+        if not compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
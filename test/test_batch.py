@@ -1,5 +1,9 @@
 import unittest
+import array
+import io
 from src.core import Batch
+from src.io import CsvOutput, TextOutput
+from pathlib import Path
 
 
 class TestBatch(unittest.TestCase):
@@ -10,6 +14,30 @@ class TestBatch(unittest.TestCase):
         batch.append(2)
         self.assertTrue(len(batch) == 2)
 
+    def test_columns(self):
+        rows = [{"id": i, "score": i / 2, "text": f"t{i}"} for i in range(3)]
+        batch = Batch.from_rows(rows)
+        self.assertEqual(batch.columns, ["id", "score", "text"])
+        self.assertIsInstance(batch.column("id"), array.array)
+        self.assertIsInstance(batch.column("score"), array.array)
+        batch.append({"id": None, "extra": True})
+        self.assertIsInstance(batch.column("id"), list)
+        self.assertEqual(batch.to_list()[-1], {"id": None, "score": None, "text": None, "extra": True})
+        self.assertEqual(batch.to_list()[0], {"id": 0, "score": 0., "text": "t0", "extra": None})
+
+    def test_output(self):
+        basepath = Path('tmp')
+        rows = [{"a": 1, "b": "x"}, {"a": 2, "b": "y"}]
+        for output_class, kwargs in ((CsvOutput, {'sep': ','}), (TextOutput, {})):
+            expected = output_class(rows, '', basepath=basepath)
+            expected.write_buff(**kwargs)
+            output = output_class(Batch.from_rows(rows), '', basepath=basepath)
+            output.write_buff(**kwargs)
+            expected_f, f = io.BytesIO(), io.BytesIO()
+            expected.dump(expected_f)
+            output.dump(f)
+            self.assertEqual(f.getvalue(), expected_f.getvalue())
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,24 @@
+import unittest
+from benchmark import run_case, compare
+from pathlib import Path
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_case(self):
+        basepath = Path('tmp').joinpath('benchmark')
+        results = []
+        for stream in ('base', 'page', 'cursor'):
+            case = {'stream': stream, 'format': 'csv', 'concurrency': 2, 'pages': 3, 'rows': 10, 'latency': 0,
+                    'dist': 'fixed'}
+            result = run_case(case, 8080, basepath)
+            assert result['requests'] >= 3 and result['pages_s'] > 0 and result['mb_s'] > 0
+            assert result['p50'] <= result['p99']
+            results.append(result)
+        assert compare(results, {'results': results}, tolerance=.1)
+        slower = [dict(result, pages_s=result['pages_s'] / 2) for result in results]
+        assert not compare(slower, {'results': results}, tolerance=.1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import unittest
+import array
+from src.core import Request, BuffStream, BaseStream, CSVMetadata, Batch
+from src.io import CsvOutput
+from src.dedup import BloomFilter, Dedup
+import json
+from pathlib import Path
+
+
+async def pprint(session, url, headers, timeout):
+    async with session.get(url, headers=headers, timeout=timeout) as response:
+        r = await response.json()
+        r = json.loads(r)
+        return CsvOutput(r, url, basepath=Path('tmp'))
+
+
+class TestDedup(unittest.TestCase):
+
+    def test_bloom(self):
+        bloom = BloomFilter(capacity=1000, error_rate=.01)
+        assert not bloom.add(b'a')
+        assert bloom.add(b'a')
+        assert b'a' in bloom and b'b' not in bloom
+        for i in range(1000):
+            bloom.add(str(i).encode())
+        false_positives = sum(str(i).encode() in bloom for i in range(1000, 11000))
+        assert false_positives < 300
+        with open('/dev/zero', 'rb') as f:
+            self.assertRaises(Exception, BloomFilter(capacity=10).load, f)
+
+    def test_filter(self):
+        basepath = Path('tmp')
+        dedup = Dedup(basepath, capacity=1000)
+        dedup.clean()
+        output = CsvOutput([{"a": 1, "b": 2}, {"b": 2, "a": 1}, {"a": 2, "b": 2}], '', basepath=basepath)
+        assert dedup.filter(output).content == [{"a": 1, "b": 2}, {"a": 2, "b": 2}]
+        batch = Batch.from_rows([{"a": 2, "b": 2}, {"a": 3, "b": 2}])
+        output = dedup.filter(CsvOutput(batch, '', basepath=basepath))
+        assert output.content.to_list() == [{"a": 3, "b": 2}]
+        self.assertIsInstance(output.content.column("a"), array.array)
+        assert dedup.hits == 2 and dedup.records == 5
+        dedup.save()
+
+        dedup = Dedup(basepath, keys=["a"], capacity=1000)
+        output = CsvOutput([{"a": 1, "b": 5}, {"a": 9, "b": 5}], '', basepath=basepath)
+        # the key subset hashes differently from whole records
+        assert len(dedup.filter(output).content) == 2
+        assert len(dedup.filter(output).content) == 0
+        assert dedup.hit_rate() == .5
+        dedup.clean()
+
+        # a Batch pads the missing column with None, the row still matches the sparse dict
+        dedup = Dedup(basepath, capacity=1000)
+        output = CsvOutput([{"b": 1}, {"b": 2, "a": 3}], '', basepath=basepath)
+        assert len(dedup.filter(output).content) == 2
+        batch = Batch.from_rows([{"a": 3, "b": 2}, {"b": 1}, {"b": 4}])
+        assert dedup.filter(CsvOutput(batch, '', basepath=basepath)).content.to_list() == [{"a": None, "b": 4}]
+        dedup.clean()
+
+    def test_request(self):
+        basepath = Path('tmp')
+        dedup = Dedup(basepath, keys=["id"], capacity=10000)
+        dedup.clean()
+        urls = [f"http://localhost:8080/bench?rows=10&page={i}" for i in range(3)]
+        for expected in (1, 0):
+            metadata = CSVMetadata(basepath)
+            metadata.filepath().unlink(True)
+            request = Request(buff=BuffStream(stream=BaseStream(urls)), metadata=metadata,
+                              dedup=Dedup(basepath, keys=["id"], capacity=10000))
+            request.run(request.output(request.window(callback=pprint, size=1)))
+            if expected == 0:
+                assert not metadata.filepath().exists()
+            else:
+                assert len(list(metadata.read())) == expected
+                metadata.clean()
+        dedup.clean()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,7 @@
 import unittest
 from src.core import Request, BuffStream, BaseStream, DummyMetadata
 from src.io import CsvOutput
+import asyncio
 import json
 import time
 from pathlib import Path
@@ -28,6 +29,21 @@ class TestBuffStream(unittest.TestCase):
         #    print("Exception")
         #print(tasks)
 
+    def test_get_stragglers(self):
+        urls = ["http://localhost:8080/long", "http://localhost:8080/1", "http://localhost:8080/2",
+                "http://localhost:8080/3"]
+        buff = BuffStream(stream=BaseStream(urls), buff_size=2)
+        request = Request(buff=buff, metadata=DummyMetadata(Path('tmp')))
+
+        async def run():
+            # the slow page of the first batch outlives the output() timeout
+            await request.output(request.get(callback=pprint), clean=True, timeout=.5)
+            return [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+
+        start = time.time()
+        assert request.run(run()) == []
+        assert time.time() - start < 10
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,81 @@
+import unittest
+from src.core import CSVMetadata, JournalMetadata, Layout, remove_files
+from src.io import CsvOutput, Codec
+from pathlib import Path
+import pickle
+import time
+
+
+class TestMetadata(unittest.TestCase):
+
+    def test_journal(self):
+        basepath = Path('tmp')
+        metadata = JournalMetadata(basepath, flush_rows=3, flush_seconds=60)
+        metadata.clean(deep=False)
+        outputs = [CsvOutput([{"a": i}], f'http://localhost/{i}', basepath=basepath) for i in range(5)]
+        for output in outputs:
+            output.write()
+            metadata.write(output)
+        assert len(list(CSVMetadata(basepath).read())) == 3
+        metadata.error("timeout", 'http://localhost/5')
+        rows = metadata.find(url='http://localhost/4')
+        assert rows == [['1', outputs[4].filename(), 'http://localhost/4', '6', '']]
+        assert metadata.find(id=outputs[2].id)[0][2] == 'http://localhost/2'
+        metadata.close()
+        assert len(list(metadata.read())) == 6
+        metadata.clean()
+        assert not metadata.filepath().exists()
+        assert not metadata.index_filepath().exists()
+        for output in outputs:
+            assert not output.filepath().exists()
+
+        # a stalled crawl still gets its buffered rows flushed on time
+        metadata = JournalMetadata(basepath, flush_rows=1000, flush_seconds=.1)
+        metadata.error("timeout", 'http://localhost/6')
+        time.sleep(.5)
+        assert len(list(CSVMetadata(basepath).read())) == 1
+        metadata.clean()
+
+    def test_layout(self):
+        basepath = Path('tmp').joinpath('layout')
+        layout = Layout(depth=2, width=2)
+        for metadata_class in (CSVMetadata, JournalMetadata):
+            metadata = metadata_class(basepath)
+            metadata.clean(deep=False)
+            outputs = [CsvOutput([{"a": i}], f'http://localhost/{i}', basepath=basepath, layout=layout)
+                       for i in range(5)]
+            for output in outputs:
+                output.write()
+                metadata.write(output)
+            metadata.close()
+            for output, line in zip(outputs, metadata.read()):
+                assert line[1] == f'{output.id[:2]}/{output.id[2:4]}/{output.id}.csv'
+                assert basepath.joinpath(line[1]).exists()
+            metadata.clean()
+            assert not any(output.filepath().exists() for output in outputs)
+
+        compressed = Codec('gzip')(CsvOutput([{"a": 1}], 'http://localhost/1', basepath=basepath, layout=layout))
+        assert compressed.filepath().parent == outputs[1].filepath().parent
+        assert pickle.loads(pickle.dumps(layout)).shard(outputs[0].id) == layout.shard(outputs[0].id)
+
+        for output in outputs:
+            output.write()
+        assert len(layout.shards(basepath)) == len({output.id[:2] for output in outputs})
+        layout.remove(basepath, shards=[outputs[0].id[:2]])
+        assert not basepath.joinpath(outputs[0].id[:2]).exists()
+        # the directory cache is invalidated for removed shards
+        outputs[0].write()
+        assert outputs[0].filepath().exists()
+        layout.remove(basepath)
+        assert layout.shards(basepath) == []
+        basepath.rmdir()
+
+        basepath.mkdir(parents=True)
+        for i in range(10):
+            basepath.joinpath(str(i)).touch()
+        assert remove_files(basepath, (str(i) for i in range(12)), workers=3, batch_size=4) == 10
+        basepath.rmdir()
+
+
+if __name__ == '__main__':
+    unittest.main()
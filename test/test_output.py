@@ -1,5 +1,13 @@
 import unittest
-from src.io import CsvOutput, TextOutput, OrcOuput, GzipOutput
+from src.io import CsvOutput, TextOutput, OrcOuput, GzipOutput, Codec, RollingSink, OrcSink, orc_schema, \
+    orc_columns, orc_rows, orc_widen, orc_merge, RawOutput, pyorc
+from src.core import Batch, persist
+import io
+import gzip
+import tracemalloc
+import zlib
+import bz2
+import lzma
 from pathlib import Path
 
 
@@ -13,6 +21,73 @@ class TestOutput(unittest.TestCase):
         # assert output.filepath().stat().st_size == ?
         # output.clean()
 
+    def test_orc_schema(self):
+        basepath = Path('tmp')
+        rows = [{"a": None, "b": "x", "c": 1.5}, {"c": 2., "b": "y", "a": 3}]
+        output = OrcOuput(rows, '', basepath=basepath)
+        assert orc_schema(output) == "struct<a:bigint,b:string,c:double>"
+        assert orc_schema(output, types={"a": "int"}) == "struct<a:int,b:string,c:double>"
+        output = OrcOuput(Batch.from_rows([{"a": True, "b": None}]), '', basepath=basepath)
+        assert orc_schema(output) == "struct<a:boolean,b:string>"
+        # widened over the sample, nested values are written as json text
+        rows = [{"a": 1, "b": {"x": 1}, "c": 1}, {"a": 2.5, "b": [1], "c": "z"}]
+        output = OrcOuput(rows, '', basepath=basepath)
+        assert orc_schema(output) == "struct<a:double,b:string,c:string>"
+        columns = orc_columns(output)
+        assert list(orc_rows(output, list(columns), columns)) == [(1., '{"x": 1}', '1'), (2.5, '[1]', 'z')]
+        self.assertRaises(Exception, persist, output, compression=Codec('gzip'))
+
+        assert orc_widen(orc_widen(None, int), float) == 'double'
+        assert orc_widen('boolean', int) == 'string' and orc_widen('bigint', dict) == 'string'
+        assert orc_merge('bigint', None) == 'bigint' and orc_merge(None, 'double') == 'double'
+        # the empty page that ends a crawl has no schema and writes nothing
+        for content in (None, []):
+            output = OrcOuput(content, 'orc-empty', basepath=basepath)
+            assert orc_columns(output) == {}
+            output.write_disk()
+            assert not output.filepath().exists()
+
+    @unittest.skipIf(pyorc is None, "pyorc is not installed")
+    def test_orc_widened(self):
+        basepath = Path('tmp')
+        rows = [{"a": 1, "b": {"x": 1}}, {"a": 2.5, "b": None}]
+        output = OrcOuput(rows, 'orc-widened', basepath=basepath)
+        output.write()
+        with output.filepath().open('rb') as f:
+            assert list(pyorc.Reader(f)) == [(1., '{"x": 1}'), (2.5, None)]
+        output.clean()
+
+    @unittest.skipIf(pyorc is None, "pyorc is not installed")
+    def test_orc_sink(self):
+        basepath = Path('tmp').joinpath('orc')
+        basepath.mkdir(parents=True, exist_ok=True)
+        sink = OrcSink(basepath, max_records=4)
+        for i in range(5):
+            sink.write(OrcOuput([{"a": i, "b": str(i)}, {"b": str(i), "a": i}], f'orc{i}', basepath=basepath))
+        sink.close()
+        rows = []
+        for path in sorted(basepath.iterdir()):
+            with path.open('rb') as f:
+                rows.extend(pyorc.Reader(f))
+            path.unlink()
+        basepath.rmdir()
+        assert rows == [(i, str(i)) for i in range(5) for _ in range(2)]
+
+        # a float in a bigint column starts a part with the widened schema
+        basepath.mkdir(parents=True, exist_ok=True)
+        sink = OrcSink(basepath)
+        sink.write(OrcOuput([{"a": 1}], 'orc-int', basepath=basepath))
+        sink.write(OrcOuput([{"a": 1.5, "b": "x"}], 'orc-float', basepath=basepath))
+        sink.close()
+        assert sink.schema == "struct<a:double,b:string>"
+        rows = []
+        for path in sorted(basepath.iterdir()):
+            with path.open('rb') as f:
+                rows.extend(pyorc.Reader(f))
+            path.unlink()
+        basepath.rmdir()
+        assert rows == [(1,), (1.5, 'x')]
+
     def test_csv(self):
         basepath = Path('tmp')
         output = CsvOutput([{"a": 1, "b": 2, "c": 3}], '', basepath=basepath)
@@ -27,6 +102,30 @@ class TestOutput(unittest.TestCase):
         assert output.filepath().stat().st_size == 26
         output.clean()
 
+    def test_encode(self):
+        basepath = Path('tmp')
+        rows = [{"a": i, "b": f"text {i}", "c": i / 3} for i in range(20000)]
+        for output in (CsvOutput(rows, 'encode', basepath=basepath), TextOutput(rows, 'encode', basepath=basepath)):
+            output.write_buff(**({'header': False, 'sep': ','} if isinstance(output, CsvOutput) else {}))
+            tracemalloc.start()
+            output.write_disk()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            # the payload is never held whole in memory, only a chunk of it
+            assert output.nbytes == output.filepath().stat().st_size > 4 * 2**16
+            assert peak < output.nbytes / 2
+            with output.filepath().open('r', encoding='utf-8', newline='') as f:
+                text = f.read()
+            if isinstance(output, CsvOutput):
+                assert text.startswith('0,text 0,0.0\r\n1,text 1,')
+            else:
+                assert text == str(rows)
+            output.clean()
+        output = TextOutput({"a": [1, 2]}, 'encode', basepath=basepath)
+        output.write()
+        assert output.filepath().read_text() == str({"a": [1, 2]})
+        output.clean()
+
 
 class TestCompress(unittest.TestCase):
     def test_gzip(self):
@@ -38,6 +137,53 @@ class TestCompress(unittest.TestCase):
         gz_out.write_disk()
         gz_out.clean()
 
+    def test_codecs(self):
+        basepath = Path('tmp')
+        output = CsvOutput([{"a": i, "b": str(i)} for i in range(1000)], 'codec', basepath=basepath)
+        output.write_buff()
+        raw = io.BytesIO()
+        output.dump(raw)
+        raw = raw.getvalue()
+        for name, decompress in (('gzip', gzip.decompress), ('zlib', zlib.decompress),
+                                 ('bz2', bz2.decompress), ('lzma', lzma.decompress)):
+            compressed = Codec(name, level=1)(output)
+            compressed.write_disk()
+            assert compressed.filepath().name.endswith(compressed.codec.file_extension)
+            assert decompress(compressed.filepath().read_bytes()) == raw
+            assert compressed.raw_nbytes == len(raw)
+            assert compressed.ratio() > 1
+            compressed.clean()
+
+
+class TestSink(unittest.TestCase):
+    def test_rolling(self):
+        basepath = Path('tmp').joinpath('sink')
+        basepath.mkdir(parents=True, exist_ok=True)
+        sink = RollingSink(basepath, max_records=4)
+        outputs = []
+        for i in range(5):
+            output = CsvOutput([{"a": i, "b": 2}, {"a": i, "b": 3}], f'sink{i}', basepath=basepath)
+            output.write_buff(header=False)
+            gz_out = GzipOutput(output)
+            sink.write(gz_out)
+            outputs.append(gz_out)
+        sink.close()
+        assert len({output.part for output in outputs}) == 3
+        for i, output in enumerate(outputs):
+            with basepath.joinpath(output.part).open('rb') as f:
+                f.seek(output.offset)
+                data = gzip.decompress(f.read(output.nbytes))
+            assert data == f'{i}|2\r\n{i}|3\r\n'.encode()
+        # a raw body is already on disk, the part would only get 0 bytes
+        raw = RawOutput('sink-raw', basepath=basepath)
+        raw.bytes_received = 10
+        self.assertRaises(Exception, RollingSink(basepath).write, raw)
+        self.assertRaises(Exception, RollingSink(basepath).write, OrcOuput([{"a": 1}], 'sink-orc', basepath=basepath))
+        self.assertRaises(Exception, OrcSink(basepath).write, raw)
+        for path in basepath.iterdir():
+            path.unlink()
+        basepath.rmdir()
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,6 +1,14 @@
 import unittest
-from src.core import Request, BuffStream, BaseStream, DummyMetadata
-from src.io import CsvOutput
+from src.core import Request, BuffStream, BaseStream, StreamPage, DummyMetadata, CSVMetadata, SessionPool, \
+    WriterPool, AIMDController, RetryPolicy, Hedge, DigestSet
+from src.io import CsvOutput, RawOutput, Codec
+from src.fetch import StreamFetch, JsonFetch, PassthroughFetch
+from src.cache import HttpCache
+from src.metrics import Metrics, Histogram
+import asyncio
+import aiohttp
+import gzip
+import zlib
 import json
 import time
 from pathlib import Path
@@ -40,6 +48,357 @@ class TestBuffStream(unittest.TestCase):
         output = request.output(request.get(callback=pprint, timeout=1))
         tasks = request.run(output)
 
+    def test_pool(self):
+        basepath = Path('tmp')
+        buff = BuffStream(stream=BaseStream(["http://localhost:8080/1", "http://localhost:8080/2",
+                                             "http://localhost:8080/3"]), buff_size=2)
+        metadata = CSVMetadata(basepath)
+        pool = SessionPool(limit=10, limit_per_host=2, keepalive_timeout=30, ttl_dns_cache=300)
+        request = Request(buff=buff, metadata=metadata, pool=pool)
+        output = request.output(request.get(callback=pprint), clean=True)
+        request.run(output)
+        assert len(list(metadata.read())) == 3
+        metadata.clean(deep=False)
+
+    def test_window(self):
+        basepath = Path('tmp')
+        buff = BuffStream(stream=BaseStream(["http://localhost:8080/rand"] * 4 + ["http://localhost:8080/1"] * 2))
+        metadata = CSVMetadata(basepath)
+        request = Request(buff=buff, metadata=metadata)
+        output = request.output(request.window(callback=pprint, size=3), clean=True)
+        request.run(output)
+        assert len(list(metadata.read())) == 6
+        metadata.clean(deep=False)
+
+    def test_writer_pool(self):
+        basepath = Path('tmp')
+        for executor in ('thread', 'process'):
+            buff = BuffStream(stream=BaseStream(["http://localhost:8080/1", "http://localhost:8080/2",
+                                                 "http://localhost:8080/3"]))
+            metadata = CSVMetadata(basepath)
+            request = Request(buff=buff, metadata=metadata)
+            writer = WriterPool(workers=2, executor=executor, maxsize=1)
+            output = request.output(request.window(callback=pprint), writer=writer, sep='|')
+            request.run(output)
+            lines = list(metadata.read())
+            assert len(lines) == 3
+            for line in lines:
+                assert basepath.joinpath(line[1]).stat().st_size > 0
+            metadata.clean()
+
+    def test_stream_fetch(self):
+        basepath = Path('tmp')
+        for codec in (None, Codec('gzip', 6)):
+            buff = BuffStream(stream=BaseStream(["http://localhost:8080/1"]))
+            metadata = CSVMetadata(basepath)
+            request = Request(buff=buff, metadata=metadata)
+            fetch = StreamFetch(basepath, chunk_size=1024, file_extension='json', codec=codec)
+            request.run(request.output(request.window(callback=fetch)))
+            (received, filename, _, nbytes, _), = metadata.read()
+            data = basepath.joinpath(filename).read_bytes()
+            assert int(nbytes) == len(data)
+            if codec is not None:
+                data = gzip.decompress(data)
+            assert int(received) == len(data)
+            assert len(json.loads(json.loads(data))) == 1000
+            metadata.clean()
+
+        # the body is already on disk, compressing it again in persist would write an empty stream
+        buff = BuffStream(stream=BaseStream(["http://localhost:8080/1"]))
+        metadata = CSVMetadata(basepath)
+        request = Request(buff=buff, metadata=metadata)
+        fetch = StreamFetch(basepath, file_extension='json')
+        self.assertRaisesRegex(Exception, 'can not be compressed', request.run,
+                               request.output(request.window(callback=fetch), compression=Codec('gzip')))
+        RawOutput("http://localhost:8080/1", basepath=basepath, file_extension='json').clean()
+        metadata.clean()
+
+    def test_resume(self):
+        basepath = Path('tmp')
+        metadata = CSVMetadata(basepath)
+        metadata.filepath().unlink(True)
+        urls = ["http://localhost:8080/1", "http://localhost:8080/2", "http://localhost:8080/3"]
+        for seq, resume in ((urls[:1], False), (urls, True)):
+            buff = BuffStream(stream=BaseStream(seq))
+            request = Request(buff=buff, metadata=metadata, resume=resume)
+            request.run(request.output(request.window(callback=pprint)))
+        assert sorted(line[2] for line in metadata.read()) == urls
+        assert urls[0] in request.completed and urls[1] not in request.completed
+        metadata.clean()
+
+        # the table grows past its initial capacity and keeps every url
+        urls = [f"http://localhost:8080/{i}" for i in range(5000)]
+        completed = DigestSet(urls + urls[:100], capacity=8)
+        assert len(completed) == 5000 and len(completed.table) == 8192
+        assert len(DigestSet(capacity=1000).table) == 1024
+        assert all(url in completed for url in urls) and "http://localhost:8080/rand" not in completed
+
+    def test_cache(self):
+        basepath = Path('tmp')
+        cache = HttpCache(basepath.joinpath('cache'))
+        for _ in range(2):
+            buff = BuffStream(stream=BaseStream(["http://localhost:8080/etag"]))
+            request = Request(buff=buff, metadata=DummyMetadata(basepath), cache=cache)
+            request.run(request.output(request.window(callback=pprint), clean=True))
+        assert cache.misses == 1 and cache.hits == 1
+        assert "http://localhost:8080/etag" in HttpCache(basepath.joinpath('cache'))
+        cache.clean()
+
+        async def failing(session, url, headers, timeout):
+            await pprint(session, url, headers, timeout)
+            raise ValueError("callback failed after the body was cached")
+
+        # a failed run still saves the index of the bodies it cached
+        cache = HttpCache(basepath.joinpath('cache'))
+        buff = BuffStream(stream=BaseStream(["http://localhost:8080/etag"]))
+        request = Request(buff=buff, metadata=DummyMetadata(basepath), cache=cache)
+        self.assertRaises(ValueError, request.run, request.output(request.window(callback=failing), clean=True))
+        assert "http://localhost:8080/etag" in HttpCache(basepath.joinpath('cache'))
+        cache.clean()
+
+    def test_controller(self):
+        controller = AIMDController(initial=2, maximum=8)
+
+        async def slots(n):
+            for _ in range(n):
+                async with controller.slot("http://localhost:8080/1"):
+                    await asyncio.sleep(.01)
+
+        asyncio.run(slots(40))
+        assert controller.limits() == {'localhost:8080': 8}
+        controller.congestion('localhost:8080')
+        assert controller.limits() == {'localhost:8080': 4}
+
+        buff = BuffStream(stream=BaseStream(["http://localhost:8080/1"] * 10))
+        request = Request(buff=buff, metadata=DummyMetadata(Path('tmp')), controller=controller)
+        request.run(request.output(request.window(callback=pprint, size=10), clean=True))
+        assert controller.state('localhost:8080').in_flight == 0
+
+        # the same controller under contention in a second run, the window follows its maximum
+        controller = AIMDController(initial=2, maximum=6)
+        peaks = []
+
+        async def counted(session, url, headers, timeout):
+            peaks.append(controller.state('localhost:8080').in_flight)
+            return await pprint(session, url, headers, timeout)
+
+        for _ in range(2):
+            buff = BuffStream(stream=BaseStream(["http://localhost:8080/1"] * 30), buff_size=2)
+            request = Request(buff=buff, metadata=DummyMetadata(Path('tmp')), controller=controller)
+            request.run(request.output(request.window(callback=counted), clean=True))
+            assert controller.state('localhost:8080').in_flight == 0
+        assert len(peaks) == 60
+        assert max(peaks) > 2
+
+    def test_retry(self):
+        calls = []
+
+        async def flaky(session, url, headers, timeout):
+            calls.append(url)
+            if len(calls) < 3:
+                raise aiohttp.ServerDisconnectedError()
+            return CsvOutput([{"a": 1}], url, basepath=Path('tmp'))
+
+        buff = BuffStream(stream=BaseStream(["http://localhost:8080/1"]))
+        metadata = CSVMetadata(Path('tmp'))
+        metadata.filepath().unlink(True)
+        retry = RetryPolicy(attempts={aiohttp.ServerDisconnectedError: 2}, base=.01)
+        request = Request(buff=buff, metadata=metadata, retry=retry)
+        request.run(request.output(request.window(callback=flaky)))
+        assert len(calls) == 3
+        assert len(list(metadata.read())) == 1
+        metadata.clean()
+
+    def test_hedge(self):
+        calls = []
+
+        async def slow_first(session, url, headers, timeout):
+            calls.append(url)
+            await asyncio.sleep(2 if len(calls) == 1 else .01)
+            return CsvOutput([{"a": len(calls)}], url, basepath=Path('tmp'))
+
+        hedge = Hedge(percentile=.5, min_samples=1)
+        hedge.observe(.05)
+        buff = BuffStream(stream=BaseStream(["http://localhost:8080/1"]))
+        request = Request(buff=buff, metadata=DummyMetadata(Path('tmp')), hedge=hedge)
+        start = time.time()
+        request.run(request.output(request.window(callback=slow_first), clean=True))
+        assert time.time() - start < 1
+        assert len(calls) == 2 and hedge.hedged == 1
+
+        # the percentile is only sorted again after `refresh` new samples
+        hedge = Hedge(percentile=.5, min_samples=1, refresh=3)
+        hedge.observe(1.)
+        assert hedge.delay() == 1.
+        hedge.observe(3.)
+        hedge.observe(3.)
+        assert hedge.delay() == 1.
+        hedge.observe(3.)
+        assert hedge.delay() == 3.
+
+    def test_json_fetch(self):
+        basepath = Path('tmp')
+        metadata = CSVMetadata(basepath)
+        metadata.filepath().unlink(True)
+        buff = BuffStream(stream=BaseStream(["http://localhost:8080/1", "http://localhost:8080/4"]))
+        request = Request(buff=buff, metadata=metadata)
+        fetch = JsonFetch(basepath, embedded=True, threshold=1024)
+        request.run(request.output(request.window(callback=fetch)))
+        (length, _, url, _, _), = metadata.read()
+        assert length == '1000' and url == "http://localhost:8080/1"
+        metadata.clean()
+
+        fetch = JsonFetch(basepath, key='data.items')
+        assert fetch.decode(b'{"data": {"items": [{"a": 1}]}, "next": 2}') == [{"a": 1}]
+        fetch = JsonFetch(basepath, lines=True)
+        assert fetch.decode(b'{"a": 1}\n{"a": 2}\n') == [{"a": 1}, {"a": 2}]
+
+        # json lines crossing chunk boundaries are decoded while the body streams in
+        for batch in (False, True):
+            output = None
+
+            async def fetch_lines(session, url, headers, timeout):
+                nonlocal output
+                output = await JsonFetch(basepath, lines=True, batch=batch)(session, url, headers, timeout)
+                return output
+
+            buff = BuffStream(stream=BaseStream(["http://localhost:8080/lines?rows=500"]))
+            request = Request(buff=buff, metadata=DummyMetadata(basepath))
+            request.run(request.output(request.window(callback=fetch_lines), clean=True))
+            rows = output.content.to_list() if batch else output.content
+            assert [row["id"] for row in rows] == list(range(500))
+
+    def test_metrics(self):
+        basepath = Path('tmp')
+        basepath.mkdir(exist_ok=True)
+        snapshots = []
+        metrics = Metrics(basepath.joinpath('metrics.prom'), interval=.05, hook=snapshots.append)
+        for writer in (None, WriterPool(workers=2)):
+            buff = BuffStream(stream=BaseStream(["http://localhost:8080/1", "http://localhost:8080/2",
+                                                 "http://localhost:8080/3"]))
+            metadata = CSVMetadata(basepath)
+            metadata.filepath().unlink(True)
+            request = Request(buff=buff, metadata=metadata, metrics=metrics)
+            request.run(request.output(request.window(callback=pprint), writer=writer, clean=True))
+            metadata.clean()
+        domain = "localhost:8080"
+        assert metrics.histograms[('ttfb', domain)].count == 6
+        assert metrics.histograms[('total', domain)].count == 6
+        assert metrics.histograms[('write', domain)].count == 6
+        assert metrics.histograms[('writer_lag', domain)].count == 3
+        assert metrics.counters[('bytes_received', domain)] > 0
+        assert metrics.counters[('bytes_written', domain)] > 0
+        # dns timings share the host:port label, the queue depth drops back once the writers drained
+        assert {key for _, key in metrics.histograms} == {domain}
+        assert metrics.gauges['writer_queue_depth'] == 0
+        assert len(snapshots) >= 2
+        text = basepath.joinpath('metrics.prom').read_text()
+        assert f'traepi_seconds_count{{phase="ttfb",domain="{domain}"}} 6' in text
+        assert 'traepi_writer_queue_depth' in text
+        basepath.joinpath('metrics.prom').unlink()
+
+        histogram = Histogram(bounds=(1, 2, 4))
+        for value in (.5, 1.5, 1.5, 3, 10):
+            histogram.observe(value)
+        assert histogram.quantile(.5) == 2 and histogram.quantile(1) == float('inf')
+        assert list(histogram.cumulative()) == [(1, 1), (2, 3), (4, 4), (float('inf'), 5)]
+
+    def test_outputs(self):
+        basepath = Path('tmp')
+        # the first urls answer last
+        urls = [f"http://localhost:8080/bench?rows=2&latency={(5 - i) * .04:.2f}&id={i}" for i in range(6)]
+
+        async def consume(request, coro, **kwargs):
+            return [output async for output in request.outputs(coro, **kwargs)]
+
+        for ordered in (True, False):
+            metadata = CSVMetadata(basepath)
+            metadata.filepath().unlink(True)
+            request = Request(buff=BuffStream(stream=BaseStream(urls)), metadata=metadata)
+            outputs = request.run(consume(request, request.window(callback=pprint, size=6), ordered=ordered))
+            assert sorted(output.url for output in outputs) == sorted(urls)
+            if ordered:
+                assert [output.url for output in outputs] == urls
+            else:
+                assert outputs[0].url == urls[-1]
+            assert all(not output.filepath().exists() for output in outputs)
+            assert not metadata.filepath().exists()
+
+        request = Request(buff=BuffStream(stream=BaseStream(urls), buff_size=4), metadata=DummyMetadata(basepath))
+        records = request.run(consume(request, request.get(callback=pprint), ordered=True, records=True))
+        assert records == [[{"id": i, "text": url, "date": r[0]["date"]} for i in range(2)]
+                           for url, r in zip(urls, records)]
+
+        calls = []
+
+        async def counted(session, url, headers, timeout):
+            calls.append(url)
+            return await pprint(session, url, headers, timeout)
+
+        async def slow_consumer(request):
+            async for output in request.outputs(request.window(callback=counted, size=2), size=1):
+                await asyncio.sleep(.3)
+                # fetching waits for the consumer: one output queued, one waiting to be queued, two in flight
+                assert len(calls) <= 5
+                break
+
+        urls = [f"http://localhost:8080/bench?rows=1&id={i}" for i in range(20)]
+        request = Request(buff=BuffStream(stream=BaseStream(urls)), metadata=DummyMetadata(basepath))
+        request.run(slow_consumer(request))
+        assert len(calls) <= 5
+
+        calls = []
+
+        async def failing(session, url, headers, timeout):
+            calls.append(url)
+            if request.buff.stream.page(url) == 1:
+                return None
+            return await pprint(session, url, headers, timeout)
+
+        async def gap_consumer(request):
+            pages = []
+            coro = request.prefetch(callback=failing, size=2, maximum=2)
+            async for output in request.outputs(coro, ordered=True):
+                # a failed page does not hold back the pages after it until the end of the stream
+                assert len(calls) <= len(pages) + 5
+                assert len(request.order) <= 3
+                pages.append(request.buff.stream.page(output.url))
+            return pages
+
+        stream = StreamPage(resource="http://localhost:8080/bench", key='pageIndex', pages=10, rows=1, latency=.05)
+        request = Request(buff=BuffStream(stream=stream), metadata=DummyMetadata(basepath))
+        assert request.run(gap_consumer(request)) == [0] + list(range(2, 10))
+        assert request.order == {} and request.skipped == set()
+
+    def test_passthrough_fetch(self):
+        basepath = Path('tmp')
+        metadata = CSVMetadata(basepath)
+        metadata.filepath().unlink(True)
+        urls = ["http://localhost:8080/gzip", "http://localhost:8080/bench?rows=3"]
+        request = Request(buff=BuffStream(stream=BaseStream(urls)), metadata=metadata)
+        request.run(request.output(request.window(callback=PassthroughFetch(basepath))))
+        lines = {line[2]: line for line in metadata.read()}
+        assert len(lines) == 2
+        for url, (length, filename, _, nbytes, _) in lines.items():
+            assert filename.endswith('.json.gz')
+            data = basepath.joinpath(filename).read_bytes()
+            # the compressed size on disk and the decoded size of the body
+            assert int(nbytes) == len(data)
+            assert int(length) == len(gzip.decompress(data))
+        filename = lines["http://localhost:8080/gzip"][1]
+        assert json.loads(gzip.decompress(basepath.joinpath(filename).read_bytes()))[0]["id"] == 0
+        metadata.clean()
+        self.assertRaises(Exception, PassthroughFetch, basepath, codec=Codec('lzma'))
+
+        # deflate has no size trailer, the length is counted while the body streams to disk
+        request = Request(buff=BuffStream(stream=BaseStream(urls[:1])), metadata=metadata)
+        request.run(request.output(request.window(callback=PassthroughFetch(basepath, codec=Codec('zlib')))))
+        (length, filename, _, nbytes, _), = metadata.read()
+        data = basepath.joinpath(filename).read_bytes()
+        assert filename.endswith('.json.zz') and int(nbytes) == len(data)
+        assert int(length) == len(zlib.decompress(data)) > len(data)
+        metadata.clean()
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,129 @@
+import unittest
+from src.core import BaseStream, FileStream, TemplateStream, StreamPage, StreamPageWait, AsyncStream, \
+    CSVMetadata, JournalMetadata
+from src.io import CsvOutput, TextOutput
+from src.runner import ShardedRunner
+import json
+from pathlib import Path
+
+
+async def pprint(session, url, headers, timeout):
+    async with session.get(url, headers=headers, timeout=timeout) as response:
+        r = await response.json()
+        r = json.loads(r)
+        return CsvOutput(r, url, basepath=Path('tmp'))
+
+
+async def pprint_text(session, url, headers, timeout):
+    async with session.get(url, headers=headers, timeout=timeout) as response:
+        r = await response.json()
+        r = json.loads(r)
+        return TextOutput(r, url, basepath=Path('tmp'))
+
+
+async def pprint_timeout(session, url, headers, timeout):
+    return await pprint(session, url, headers, 1)
+
+
+class TestRunner(unittest.TestCase):
+
+    def test_sharded_urls(self):
+        basepath = Path('tmp')
+        basepath.mkdir(exist_ok=True)
+        CSVMetadata(basepath).filepath().unlink(True)
+        urls = [f"http://localhost:8080/{i}" for i in (1, 2, 3)] + ["http://localhost:8080/rand"]
+        runner = ShardedRunner(workers=2)
+        totals = runner.run(BaseStream(urls), pprint, basepath, clean=True)
+        assert totals == {'outputs': 4, 'errors': 0}
+        metadata = CSVMetadata(basepath)
+        assert sorted(line[2] for line in metadata.read()) == sorted(urls)
+        assert not basepath.joinpath('metadata-0.csv').exists()
+        metadata.clean()
+
+    def test_sharded_pages(self):
+        basepath = Path('tmp')
+        basepath.mkdir(exist_ok=True)
+        metadata = JournalMetadata(basepath)
+        metadata.clean(deep=False)
+        streams = [StreamPage(resource="http://localhost:8080/pag", key='pageIndex', pageSize=size)
+                   for size in (10, 20, 30)]
+        runner = ShardedRunner(workers=2, mode='prefetch')
+        totals = runner.run(streams, pprint_text, basepath, metadata_class=JournalMetadata)
+        assert totals['outputs'] == 15
+        assert len(metadata.find(url=streams[2].url)) == 1
+        metadata.clean()
+
+    def test_sharded_resume(self):
+        basepath = Path('tmp')
+        basepath.mkdir(exist_ok=True)
+        CSVMetadata(basepath).filepath().unlink(True)
+        urls = [f"http://localhost:8080/{i}" for i in (1, 2, 3)]
+        runner = ShardedRunner(workers=2)
+        assert runner.run(BaseStream(urls[:2]), pprint, basepath)['outputs'] == 2
+        # the shard journals were merged away, the second run still skips the urls done by the first
+        totals = runner.run(BaseStream(urls), pprint, basepath, request_kwargs={'resume': True})
+        assert totals == {'outputs': 1, 'errors': 0}
+        metadata = CSVMetadata(basepath)
+        assert sorted(line[2] for line in metadata.read()) == urls
+        metadata.clean()
+
+    def test_sharded_errors(self):
+        basepath = Path('tmp')
+        basepath.mkdir(exist_ok=True)
+        CSVMetadata(basepath).filepath().unlink(True)
+        # a refused connection and a timeout next to a page that succeeds
+        urls = ["http://localhost:8080/1", "http://localhost:1/refused", "http://localhost:8080/long"]
+        runner = ShardedRunner(workers=2)
+        totals = runner.run(BaseStream(urls), pprint_timeout, basepath)
+        assert totals == {'outputs': 1, 'errors': 2}
+        metadata = CSVMetadata(basepath)
+        assert sorted(line[0] for line in metadata.read() if line[1] == '') == ['connection', 'timeout']
+        metadata.clean()
+
+    def run_sharded(self, stream, urls):
+        basepath = Path('tmp')
+        basepath.mkdir(exist_ok=True)
+        CSVMetadata(basepath).filepath().unlink(True)
+        runner = ShardedRunner(workers=2)
+        totals = runner.run(stream, pprint, basepath, clean=True)
+        assert totals == {'outputs': len(urls), 'errors': 0}
+        metadata = CSVMetadata(basepath)
+        assert sorted(line[2] for line in metadata.read()) == sorted(urls)
+        metadata.clean()
+
+    def test_sharded_file(self):
+        basepath = Path('tmp')
+        basepath.mkdir(exist_ok=True)
+        urls = [f"http://localhost:8080/{i}" for i in (1, 2, 3)]
+        filepath = basepath.joinpath('urls.txt')
+        filepath.write_text('# urls\n' + '\n'.join(urls) + '\n', encoding='utf-8')
+        for use_mmap in (False, True):
+            self.run_sharded(FileStream(filepath, use_mmap=use_mmap), urls)
+        filepath.unlink()
+
+    def test_sharded_template(self):
+        stream = TemplateStream("http://localhost:8080/pag", 'pageIndex', range(4), pageSize=10)
+        urls = [StreamPage.build_url("http://localhost:8080/pag", {'pageSize': 10, 'pageIndex': i})
+                for i in range(4)]
+        self.run_sharded(stream, urls)
+
+    def test_sharded_rejected(self):
+        runner = ShardedRunner(workers=2)
+        urls = (f"http://localhost:8080/{i}" for i in (1, 2, 3))
+        with self.assertRaisesRegex(Exception, 'one-shot generator'):
+            runner.run(BaseStream(urls), pprint, Path('tmp'))
+        with self.assertRaisesRegex(Exception, 'paged stream'):
+            runner.run(StreamPage(resource="http://localhost:8080/pag", key='pageIndex'), pprint, Path('tmp'))
+        with self.assertRaisesRegex(Exception, 'paged stream'):
+            runner.run(StreamPageWait(resource="http://localhost:8080/pag", key='pageIndex',
+                                      response_wait_key='next'), pprint, Path('tmp'))
+
+        async def aurls():
+            yield "http://localhost:8080/1"
+
+        with self.assertRaisesRegex(Exception, 'async stream'):
+            runner.run(AsyncStream(aurls()), pprint, Path('tmp'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,13 @@
 import unittest
-from src.core import Request, BuffStream, StreamPage, StreamPageWait, CSVMetadata
-from src.io import TextOutput
+import asyncio
 import json
-from src.core import DummyMetadata
+import pickle
+import time
+import tracemalloc
 from pathlib import Path
+from src.core import Request, BuffStream, StreamPage, StreamPageWait, CSVMetadata, BaseStream, FileStream, \
+    AsyncStream, TemplateStream, DummyMetadata
+from src.io import CsvOutput, TextOutput
 
 
 class TestPageStream(unittest.TestCase):
@@ -47,6 +51,153 @@ class TestPageStream(unittest.TestCase):
             assert int(line[0]) >= 1
         metadata.clean()
 
+    def test_window_pag(self):
+        basepath = Path('tmp')
+
+        async def pprint(session, url, headers, timeout):
+            async with session.get(url, headers=headers, timeout=timeout) as response:
+                r = await response.json()
+                r = json.loads(r)
+                return TextOutput(r, url, headers=response.headers, basepath=basepath)
+
+        buff = BuffStream(stream=StreamPageWait(resource="http://localhost:8080/pag_h", key='pageIndex',
+                                                response_wait_key='next', pageSize=100))
+        metadata = CSVMetadata(basepath)
+        metadata.filepath().unlink(True)
+        request = Request(buff=buff, metadata=metadata)
+        output = request.output(request.window(callback=pprint, size=4))
+        request.run(output)
+        urls = [line[2] for line in metadata.read()]
+        assert len(urls) == 5
+        assert urls == sorted(urls)
+        metadata.clean()
+
+    def test_resume_pag(self):
+        basepath = Path('tmp')
+
+        async def pprint(session, url, headers, timeout):
+            async with session.get(url, headers=headers, timeout=timeout) as response:
+                r = await response.json()
+                r = json.loads(r)
+                return TextOutput(r, url, headers=response.headers, basepath=basepath)
+
+        metadata = CSVMetadata(basepath)
+        metadata.filepath().unlink(True)
+        for resume in (False, True):
+            buff = BuffStream(stream=StreamPage(resource="http://localhost:8080/pag", key='pageIndex'), buff_size=2)
+            request = Request(buff=buff, metadata=metadata, resume=resume)
+            request.run(request.output(request.get(callback=pprint)))
+            assert len(list(metadata.read())) == 5
+        metadata.clean()
+
+        # the cursor page is fetched again for its next cursor but not stored twice
+        for resume in (False, True):
+            stream = StreamPageWait(resource="http://localhost:8080/pag_h", key='pageIndex', response_wait_key='next')
+            request = Request(buff=BuffStream(stream=stream), metadata=metadata, resume=resume)
+            request.run(request.output(request.get(callback=pprint)))
+            urls = [line[2] for line in metadata.read()]
+            assert len(urls) == len(set(urls)) == 5
+        metadata.clean()
+
+        # pages of another template in the same metadata are not restored
+        stream = StreamPage(resource="http://localhost:8080/pag", key='pageIndex', pageSize=10)
+        stream.restore("http://localhost:8080/pag?pageSize=20&pageIndex=7")
+        stream.restore("http://localhost:8080/pag_h?pageSize=10&pageIndex=7")
+        stream.restore("http://localhost:8080/pag?pageSize=10&pageIndex=3")
+        assert next(stream) == "http://localhost:8080/pag?pageSize=10&pageIndex=4"
+
+    def test_prefetch_pag(self):
+        basepath = Path('tmp')
+
+        async def pprint(session, url, headers, timeout):
+            async with session.get(url, headers=headers, timeout=timeout) as response:
+                r = await response.json()
+                r = json.loads(r)
+                return TextOutput(r, url, headers=response.headers, basepath=basepath)
+
+        metadata = CSVMetadata(basepath)
+        metadata.filepath().unlink(True)
+        buff = BuffStream(stream=StreamPage(resource="http://localhost:8080/pag", key='pageIndex'))
+        request = Request(buff=buff, metadata=metadata)
+        request.run(request.output(request.prefetch(callback=pprint, size=2)))
+        urls = [line[2] for line in metadata.read()]
+        assert len(urls) == len(set(urls)) == 5
+        metadata.clean()
+
+    def test_pipeline_pag(self):
+        basepath = Path('tmp')
+
+        async def pprint(session, url, headers, timeout):
+            async with session.get(url, headers=headers, timeout=timeout) as response:
+                r = await response.json()
+                r = json.loads(r)
+            # slow parsing keeps the window full once the next cursor is known
+            await asyncio.sleep(.6)
+            return TextOutput(r, url, headers=response.headers, basepath=basepath)
+
+        metadata = CSVMetadata(basepath)
+        metadata.filepath().unlink(True)
+        buff = BuffStream(stream=StreamPageWait(resource="http://localhost:8080/pag_h", key='pageIndex',
+                                                response_wait_key='next', pageSize=100))
+        request = Request(buff=buff, metadata=metadata)
+        cpu, start = time.process_time(), time.monotonic()
+        request.run(request.output(request.pipeline(callback=pprint, size=2)))
+        # a full window waits on the pages in flight instead of spinning on the cursor event
+        assert time.process_time() - cpu < (time.monotonic() - start) / 4
+        urls = [line[2] for line in metadata.read()]
+        assert len(urls) == len(set(urls)) == 5
+        metadata.clean()
+
+    def test_lazy_sources(self):
+        basepath = Path('tmp')
+        basepath.mkdir(exist_ok=True)
+        stream = TemplateStream("http://localhost:8080/bench", 'id', range(10**12), rows=1)
+        assert next(stream) == "http://localhost:8080/bench?rows=1&id=0"
+        assert next(stream) == "http://localhost:8080/bench?rows=1&id=1"
+        assert list(BaseStream(str(i) for i in range(3))) == ['0', '1', '2']
+        assert list(BaseStream("http://localhost:8080/1")) == ["http://localhost:8080/1"]
+        self.assertRaisesRegex(Exception, 'one-shot generator', pickle.dumps, BaseStream(str(i) for i in range(3)))
+
+        filepath = basepath.joinpath('urls.txt')
+        with filepath.open('w') as f:
+            f.write("# urls\n\n")
+            for i in range(100000):
+                f.write(f"http://localhost:8080/bench?id={i}\n")
+        for use_mmap in (False, True):
+            tracemalloc.start()
+            stream = FileStream(filepath, use_mmap=use_mmap, buffering=2**16)
+            total = sum(1 for _ in stream)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            assert total == 100000
+            assert peak < 2**20
+        # a copy continues from the next line of the file
+        stream = FileStream(filepath)
+        assert next(stream) == "http://localhost:8080/bench?id=0"
+        copy = pickle.loads(pickle.dumps(stream))
+        assert next(copy) == next(stream) == "http://localhost:8080/bench?id=1"
+        filepath.write_text('')
+        assert list(FileStream(filepath, use_mmap=True)) == []
+        filepath.unlink()
+
+        async def pprint(session, url, headers, timeout):
+            async with session.get(url, headers=headers, timeout=timeout) as response:
+                return CsvOutput(json.loads(await response.json()), url, basepath=basepath)
+
+        async def urls():
+            for i in range(4):
+                yield f"http://localhost:8080/bench?rows=1&id={i}"
+
+        self.assertRaises(Exception, BaseStream, urls())
+
+        for mode in ('get', 'window'):
+            metadata = CSVMetadata(basepath)
+            metadata.filepath().unlink(True)
+            request = Request(buff=BuffStream(stream=AsyncStream(urls()), buff_size=3), metadata=metadata)
+            request.run(request.output(getattr(request, mode)(callback=pprint)))
+            assert len(list(metadata.read())) == 4
+            metadata.clean()
+
 
 if __name__ == '__main__':
     unittest.main()
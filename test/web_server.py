@@ -4,6 +4,7 @@ import json
 import datetime
 import multidict
 import random
+import sys
 
 
 def gen_data(page_index, request) -> list:
@@ -50,6 +51,22 @@ async def pagination_header(request):
     return web.json_response(text, headers=multidict.CIMultiDict({'next': str(int(page_index) + 1)}))
 
 
+async def etag_response(request):
+    etag = '"v1"'
+    if request.headers.get('If-None-Match') == etag:
+        return web.Response(status=304, headers={'ETag': etag})
+    text = json.dumps(gen_data(0, request))
+    await asyncio.sleep(.2)
+    return web.json_response(text, headers={'ETag': etag})
+
+
+async def compressed_response(request):
+    # gzip when the client accepts it, identity otherwise
+    response = web.json_response(gen_data(0, request))
+    response.enable_compression()
+    return response
+
+
 async def to_long_response(request):
     await asyncio.sleep(20)
     return web.json_response('{}')
@@ -66,6 +83,44 @@ async def random_respose(request):
     return web.json_response(text)
 
 
+def bench_latency(query) -> float:
+    latency = float(query.get('latency', '0'))
+    dist = query.get('dist', 'fixed')
+    if dist == 'uniform':
+        return random.uniform(0, 2 * latency)
+    elif dist == 'bimodal':
+        return latency * 10 if random.uniform(0, 1) > .9 else latency
+    elif dist == 'lognormal':
+        return random.lognormvariate(0, .5) * latency
+    return latency
+
+
+async def bench(request):
+    # rows per page, latency and its distribution, and the page count for pagination all come from the query
+    page_index = int(request.query.get('pageIndex', '0'))
+    pages = int(request.query.get('pages', '0'))
+    rows = int(request.query.get('rows', '100'))
+    t = []
+    if pages == 0 or page_index < pages:
+        date = datetime.datetime.today().strftime("%Y-%m-%d %H:%M:%S.%f")
+        for i in range(rows):
+            t.append({"id": i, "text": str(request.url), "date": date})
+    await asyncio.sleep(bench_latency(request.query))
+    return web.json_response(json.dumps(t), headers={'next': str(page_index + 1)})
+
+
+async def json_lines(request):
+    # one json document per line, streamed in small chunks so lines cross chunk boundaries
+    rows = int(request.query.get('rows', '1000'))
+    response = web.StreamResponse()
+    await response.prepare(request)
+    body = ''.join(json.dumps({"id": i, "text": str(request.url)}) + '\n' for i in range(rows)).encode()
+    for i in range(0, len(body), 1000):
+        await response.write(body[i:i + 1000])
+    await response.write_eof()
+    return response
+
+
 app = web.Application()
 app.add_routes([web.get('/1', handle),
                 web.get('/2', handle),
@@ -73,8 +128,12 @@ app.add_routes([web.get('/1', handle),
                 web.get('/pag', pagination),
                 web.get('/pag_h', pagination_header),
                 web.get('/long', to_long_response),
-                web.get('/rand', random_respose)])
+                web.get('/etag', etag_response),
+                web.get('/gzip', compressed_response),
+                web.get('/rand', random_respose),
+                web.get('/bench', bench),
+                web.get('/lines', json_lines)])
 
 
 if __name__ == '__main__':
-    web.run_app(app)
+    web.run_app(app, port=int(sys.argv[1]) if len(sys.argv) > 1 else 8080)